@@ -1,15 +1,26 @@
 import os
+import io
+import errno
+import mmap
 import subprocess
 import glob
 import shutil
 import traceback
 import json
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
 from openpyxl.utils import get_column_letter
 from openpyxl.comments import Comment
 from abc import ABC, abstractmethod
+import runner
+from response_cache import ResponseCache
+from rate_limiter import KeyRateLimiter, TokenUsage, CircuitBreaker
+from corrector_agent import MOCK_TEXT
+from llm_backend import GeminiBackend, create_backend
 
 
 class CorrectionFailed(Exception):
@@ -19,7 +30,7 @@ class CorrectionFailed(Exception):
             super().__init__(message)
 
 class AbstractCorrector(ABC):
-    def __init__(self, alunos_path, testcases_path, sheet_path, numero_lab, use_ai, aluno=None):
+    def __init__(self, alunos_path, testcases_path, sheet_path, numero_lab, use_ai, aluno=None, checkpoint_students=10, checkpoint_seconds=60, merge=False, refresh_ai=False, conditional_refine=False, ai_only=False, ai_jobs=4, ai_job_max_attempts=3):
         self.alunos_path = alunos_path
         self.create_student_folders()
         self.alunos_list = sorted(os.listdir(self.alunos_path))
@@ -28,9 +39,71 @@ class AbstractCorrector(ABC):
         self.numero_lab = numero_lab
         self.use_ai = use_ai
         self.aluno = aluno
+        # Limits of each run of the student code: CPU a bit over the timeout, 2 GB of memory, 64 MB per file and no core dumps
+        self.run_limits = runner.RunLimits(cpu_seconds=6, address_space=2 * 1024 * 1024 * 1024, file_size=64 * 1024 * 1024)
+        # Merge mode updates only the rows of the students corrected now in an existing sheet, keeping manual edits
+        self.merge = merge
+        # Student -> row in the sheet, saved next to it so a single student regrade doesn't scan the whole sheet
+        self.row_index_path = os.path.splitext(sheet_path)[0] + ".linhas.json"
+        self.student_rows = {}
+        # AI responses are reused while the prompt (which has the student code) doesn't change, refresh_ai asks them again
+        self.ai_cache = None
+        self.ai_rate_limiter = None
+        self.ai_backend = None
+        # Only asks for the refined correction when the first one doesn't pass the criteria validation
+        self.conditional_refine = conditional_refine
+        self.refines = 0
+        self.skipped_refines = 0
+        self.ai_stats_lock = threading.Lock()
+        self.ai_usage = TokenUsage()
+        # Student -> category -> AI answer, with the hashes of the criteria and code it was given for
+        self.refresh_ai = refresh_ai
+        self.ai_results_path = os.path.splitext(sheet_path)[0] + ".ia.json"
+        self.ai_results = {}
+        # Student -> observation lines written by the AI, replaced in the next correction while the ones of the monitor stay
+        self.ai_observations_path = os.path.splitext(sheet_path)[0] + ".obs-ia.json"
+        self.ai_observations = {}
+        # The AI correction runs after the automatic one is saved, from a queue of students saved next to the sheet.
+        # ai_only skips the automatic correction and only resumes the queue
+        self.ai_only = ai_only
+        self.ai_jobs = ai_jobs
+        self.ai_queue_path = os.path.splitext(sheet_path)[0] + ".fila-ia.json"
+        self.ai_queue = {}
+        self.ai_job_max_attempts = ai_job_max_attempts
+        self.ai_circuit_breaker = CircuitBreaker()
+        if self.use_ai:
+            # The same backend for every student, so the SDK clients are built once
+            self.ai_backend = create_backend(MOCK_TEXT)
+            # The mock answers (AI_BACKEND=mock) are neither cached nor limited
+            if isinstance(self.ai_backend, GeminiBackend):
+                self.ai_cache = ResponseCache(os.path.join(os.path.dirname(sheet_path), "cache-ia"), refresh=refresh_ai)
+                # Requests and tokens per minute of each API key quota, shared through a file with other corrections
+                self.ai_rate_limiter = KeyRateLimiter(os.path.join(os.path.dirname(sheet_path), "limite-ia.json"), self.ai_backend.api_keys)
+            try:
+                with open(self.ai_results_path, encoding="utf-8") as ai_results_file:
+                    self.ai_results = json.load(ai_results_file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+            try:
+                with open(self.ai_queue_path, encoding="utf-8") as ai_queue_file:
+                    self.ai_queue = json.load(ai_queue_file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+            try:
+                with open(self.ai_observations_path, encoding="utf-8") as ai_observations_file:
+                    self.ai_observations = json.load(ai_observations_file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
 
         self.wb = Workbook()
         self.ws = self.wb.active
+        self.add_sheet_styles()
+
+        # The sheet is saved once at the end, and every few changed rows or seconds in case the correction crashes
+        self.checkpoint_students = checkpoint_students
+        self.checkpoint_seconds = checkpoint_seconds
+        self.students_since_save = 0
+        self.last_save_time = time.monotonic()
 
     @staticmethod
     def print_log(message, aluno_path, tipo_correcao, encoding):
@@ -38,6 +111,11 @@ class AbstractCorrector(ABC):
         with open(logs_correcao_path, "a", encoding=encoding) as logs:
             print(message, file=logs) 
 
+    def add_ai_usage(self, aluno_path, usage):
+        # In the student's log, the AI stage threads would interleave it on the terminal. The total is printed at the end
+        self.print_log(f"Uso da IA: {usage}", aluno_path, tipo_correcao="ia", encoding="utf-8")
+        self.ai_usage.add(usage)
+
     @staticmethod
     def clear_logs_file(aluno_path, tipo_correcao):
         logs_correcao_path = aluno_path + f"/logs_correcao_{tipo_correcao}.txt"
@@ -70,6 +148,32 @@ class AbstractCorrector(ABC):
             elif f.endswith(".txt") and not f.startswith("logs_correcao"):
                 os.remove(full_path)
 
+    def archive_output(self, output_path, final_output_path):
+        # A rename on the same filesystem, a copy only across devices (e.g. with the execution folder in RAM)
+        try:
+            os.replace(output_path, final_output_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy(output_path, final_output_path)
+            os.remove(output_path)
+
+    def read_output_lines(self, output_path):
+        # Split on a memory-mapped view of the archived output and decoded line by line, so only the list of lines is built
+        with open(output_path, 'rb') as output_file:
+            if os.fstat(output_file.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(output_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                lines = []
+                for raw_line in iter(data.readline, b""):
+                    line = str(raw_line, 'latin-1')
+                    if "\r" in line:
+                        # newline=None splits the lines the same way a file opened in text mode does
+                        lines.extend(io.StringIO(line, newline=None).readlines())
+                    else:
+                        lines.append(line)
+                return lines
+
     def get_and_handle_output(self, aluno_path, testcase):
         output_path = glob.glob(f'{aluno_path}/Lab*.txt')
         if not output_path:
@@ -77,10 +181,8 @@ class AbstractCorrector(ABC):
         output_folder = os.path.join(aluno_path, 'outputs')
         os.makedirs(output_folder, exist_ok=True)
         final_output_path = os.path.join(output_folder, f"{testcase}.txt")
-        shutil.copy(output_path[0], final_output_path)
-        os.remove(output_path[0])
-        with open(final_output_path, encoding='latin-1') as output_file:
-            return output_file.readlines()
+        self.archive_output(output_path[0], final_output_path)
+        return self.read_output_lines(final_output_path)
         
     def get_student_code(self, aluno_path):
         cpp_path = glob.glob(f'{aluno_path}/Lab*.cpp')
@@ -91,16 +193,9 @@ class AbstractCorrector(ABC):
 
     def compile_student_code(self, aluno_path):
         if os.path.isdir(aluno_path):
-            cpp_path = os.path.join(f'{aluno_path}/Lab*.cpp')
+            cpp_paths = runner.expand(aluno_path, 'Lab*.cpp')
             try:
-                result = subprocess.run(
-                    f'gcc {cpp_path} -o {aluno_path}/a.out',
-                    shell=True, 
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.PIPE,
-                    timeout=5
-                )
+                result = runner.compile_code('gcc', [], cpp_paths, os.path.join(aluno_path, 'a.out'), timeout=5)
                 if result.returncode == 0 and result.stderr:
                     self.print_log(f"WARNINGS NA COMPILACAO:\n{result.stderr.decode('utf-8', errors='replace')}", aluno_path, tipo_correcao="auto", encoding='utf-8')
             except subprocess.CalledProcessError as e:
@@ -113,36 +208,21 @@ class AbstractCorrector(ABC):
     def run_student_code(self, aluno_path, testcase):
         try:
             testcase_path = os.path.join(self.testcases_path, testcase)
-            subprocess.run(
-                f'cp {testcase_path}/entrada* {aluno_path}',
-                shell=True, 
-                check=True
-            )
-            subprocess.run(
-                './a.out', 
-                cwd=aluno_path, 
-                shell=True, 
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                timeout=5
-            )
-        except subprocess.CalledProcessError as e:
-            raise CorrectionFailed(f"Erro na execucao do caso teste {testcase}.\nCodigo de saida: {e.returncode}\n", aluno_path)
-        except subprocess.TimeoutExpired:
-            raise CorrectionFailed(f"Tempo limite de execucao do caso teste {testcase} excedido", aluno_path)
+            runner.copy_matching(testcase_path, 'entrada*', aluno_path)
+            result = runner.run(['./a.out'], cwd=aluno_path, timeout=5, limits=self.run_limits)
         except Exception as e:
             raise CorrectionFailed(f"Ocorreu um erro inesperado na execucao do caso teste {testcase}\n")
+        if result.timed_out:
+            raise CorrectionFailed(f"Tempo limite de execucao do caso teste {testcase} excedido", aluno_path)
+        if result.returncode != 0:
+            raise CorrectionFailed(f"Erro na execucao do caso teste {testcase}.\nCodigo de saida: {result.returncode}\n", aluno_path)
 
-    def correct_code(self, aluno_path, aluno_row, headers):
+    def correct_code(self, aluno_path):
         try:
-            code = self.get_student_code(aluno_path)
+            self.get_student_code(aluno_path)
             if self.use_ai:
-                self.clear_logs_file(aluno_path, "ia")
-                response = self.do_ai_correction(aluno_path, code)
-                json_str = "\n".join(response)
-                response_dict = json.loads(json_str)
-                self.add_corrections_to_sheet(aluno_row, response_dict, headers)
+                # Asked in the AI stage, a new correction starts the student over with no failed attempts
+                self.ai_queue[os.path.basename(aluno_path)] = {"attempts": 0, "last_error": None}
         except CorrectionFailed:
             raise CorrectionFailed()
         
@@ -154,76 +234,258 @@ class AbstractCorrector(ABC):
     def do_ai_correction(self, aluno_path, code):
         pass
 
+    @abstractmethod
+    def get_ai_headers(self):
+        pass
+
+    def add_sheet_styles(self):
+        # Named styles are stored once in the workbook, instead of a Font and Alignment for every cell
+        font = Font(name="Arial", size=10)
+        styles = [
+            NamedStyle(name="texto", font=font),
+            NamedStyle(name="cabecalho", font=font, alignment=Alignment(horizontal="center", vertical="center")),
+            NamedStyle(name="desconto", font=font, alignment=Alignment(horizontal="right"))
+        ]
+        for style in styles:
+            # A sheet opened in merge mode already has them
+            if style.name not in self.wb.named_styles:
+                self.wb.add_named_style(style)
+
+    @staticmethod
+    def format_student_name(aluno):
+        return aluno.replace("_", " ").title()
+
+    def save_row_index(self):
+        with open(self.row_index_path, "w", encoding="utf-8") as row_index_file:
+            json.dump(self.student_rows, row_index_file, indent=4, ensure_ascii=False)
+
+    def build_row_index(self):
+        names = {self.format_student_name(aluno): aluno for aluno in self.alunos_list}
+        self.student_rows = {}
+        for row in range(2, self.ws.max_row + 1):
+            name = self.ws.cell(row=row, column=1).value
+            if name in names:
+                self.student_rows[names[name]] = row
+        self.save_row_index()
+
+    def get_student_row(self, aluno):
+        row = self.student_rows.get(aluno)
+        # The rows may have been sorted or moved by hand since the index was saved
+        if row is None or self.ws.cell(row=row, column=1).value != self.format_student_name(aluno):
+            self.build_row_index()
+            row = self.student_rows.get(aluno)
+        return row
+
+    def open_correction_sheet(self):
+        self.wb = load_workbook(self.sheet_path)
+        self.ws = self.wb.active
+        self.add_sheet_styles()
+        try:
+            with open(self.row_index_path, encoding="utf-8") as row_index_file:
+                self.student_rows = json.load(row_index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.build_row_index()
+
+    def clear_student_corrections(self, aluno_row, headers):
+        # Clears only the penalty cells (and their comments) written by the AI, manual columns as Prazo are kept.
+        # The observations are merged apart
+        ai_headers = self.get_ai_headers()
+        for col_idx, header in enumerate(headers, start=1):
+            if header in ai_headers and header != "Observações (sem desconto na nota)":
+                cell = self.ws.cell(row=aluno_row, column=col_idx)
+                cell.value = None
+                cell.comment = None
+
+    def save_sheet(self):
+        self.wb.save(self.sheet_path)
+        if self.use_ai:
+            # Copies, the AI stage threads may add a student while they are written
+            with open(self.ai_results_path, "w", encoding="utf-8") as ai_results_file:
+                json.dump(self.ai_results.copy(), ai_results_file, indent=4, ensure_ascii=False)
+            with open(self.ai_queue_path, "w", encoding="utf-8") as ai_queue_file:
+                json.dump(self.ai_queue.copy(), ai_queue_file, indent=4, ensure_ascii=False)
+            with open(self.ai_observations_path, "w", encoding="utf-8") as ai_observations_file:
+                json.dump(self.ai_observations, ai_observations_file, indent=4, ensure_ascii=False)
+        self.students_since_save = 0
+        self.last_save_time = time.monotonic()
+
+    def checkpoint_sheet(self):
+        # Only called after a row was written, the automatic correction alone doesn't change the sheet
+        self.students_since_save += 1
+        if self.students_since_save >= self.checkpoint_students or time.monotonic() - self.last_save_time >= self.checkpoint_seconds:
+            self.save_sheet()
+
     def create_correction_sheet(self, headers):    
-        wb = self.wb
         ws = self.ws
         ws.title = f"Notas_Lab{self.numero_lab}_CES11_2025"
 
-        center_align = Alignment(horizontal="center", vertical="center")
         for col, header in enumerate(headers, start=1):
             cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(name="Arial", size=10)
-            cell.alignment = center_align
-
-        primeira_penalidade = 3  
-        ultima_penalidade = len(headers) - 1 
-        start_col_letter = get_column_letter(primeira_penalidade)
-        end_col_letter = get_column_letter(ultima_penalidade)
+            cell.style = "cabecalho"
 
         for row, aluno in enumerate(self.alunos_list, start=2):
-            nome_formatado = aluno.replace("_", " ").title()
-            cell = ws.cell(row=row, column=1, value=nome_formatado)
-            cell.font = Font(name="Arial", size=10)
-            nota_formula = f"=MAX(100+SUM({start_col_letter}{row}:{end_col_letter}{row}),0)"
-            cell = ws.cell(row=row, column=2, value=nota_formula)
-            cell.font = Font(name="Arial", size=10)
+            self.student_rows[aluno] = row
+            self.write_student_row(row, aluno, headers)
 
         for col, header in enumerate(headers, start=1):
             max_len = len(header)
             if col == 1:
                 for aluno in self.alunos_list:
-                    nome_formatado = aluno.replace("_", " ").title()
+                    nome_formatado = self.format_student_name(aluno)
                     if len(nome_formatado) > max_len:
                         max_len = len(nome_formatado)
             ws.column_dimensions[get_column_letter(col)].width = max_len + 1
 
         last_row = len(self.alunos_list) + 3 
         cell = ws.cell(row=last_row, column=1, value="Média")
-        cell.font = Font(name="Arial", size=10)
+        cell.style = "texto"
         media_formula = f"=SUM(B2:B{len(self.alunos_list)+1})/{len(self.alunos_list)}"
         cell = ws.cell(row=last_row, column=2, value=media_formula)
-        cell.font = Font(name="Arial", size=10)
-        
-        wb.save(self.sheet_path)
+        cell.style = "texto"
+        self.save_row_index()
+
+    def write_student_row(self, row, aluno, headers):
+        primeira_penalidade = 3  
+        ultima_penalidade = len(headers) - 1 
+        start_col_letter = get_column_letter(primeira_penalidade)
+        end_col_letter = get_column_letter(ultima_penalidade)
+        nome_formatado = self.format_student_name(aluno)
+        cell = self.ws.cell(row=row, column=1, value=nome_formatado)
+        cell.style = "texto"
+        nota_formula = f"=MAX(100+SUM({start_col_letter}{row}:{end_col_letter}{row}),0)"
+        cell = self.ws.cell(row=row, column=2, value=nota_formula)
+        cell.style = "texto"
 
-    def add_corrections_to_sheet(self, aluno_row, response_dict, headers):
-        wb = self.wb
+    def add_student_row(self, aluno, headers):
+        # A student missing from a sheet opened in merge mode (e.g. a late submission) gets a row after the last student,
+        # and the average moves down a row to include it
+        media_row = next((row for row in range(2, self.ws.max_row + 1) if self.ws.cell(row=row, column=1).value == "Média"), None)
+        if media_row is None:
+            row = self.ws.max_row + 1
+        else:
+            row = media_row - 1
+            self.ws.insert_rows(row)
+            cell = self.ws.cell(row=media_row + 1, column=2, value=f"=SUM(B2:B{row})/{row - 1}")
+            cell.style = "texto"
+        self.write_student_row(row, aluno, headers)
+        self.student_rows[aluno] = row
+        self.save_row_index()
+        print(f"Student {aluno} not found in the sheet, added at row {row}")
+        return row
+
+    def merge_observations(self, aluno, cell, observations):
+        # The lines of the previous AI correction are replaced, any other line was written by the monitor
+        previous_lines = set(self.ai_observations.get(aluno, []))
+        lines = [line for line in str(cell.value or "").splitlines() if line not in previous_lines]
+        ai_lines = [f"- {err}" for err in observations]
+        cell.value = "\n".join(lines + ai_lines).strip() or None
+        self.ai_observations[aluno] = ai_lines
+
+    def add_corrections_to_sheet(self, aluno, response_dict, headers):
         ws = self.ws
+        aluno_row = self.get_student_row(aluno)
+        if aluno_row is None:
+            aluno_row = self.add_student_row(aluno, headers)
+        self.clear_student_corrections(aluno_row, headers)
+        ai_headers = self.get_ai_headers()
         for col_idx, header in enumerate(headers, start=1):
-            if header in response_dict and response_dict[header]:
+            if header not in ai_headers:
+                continue
+            if header == "Observações (sem desconto na nota)":
+                cell = ws.cell(row=aluno_row, column=col_idx)
+                cell.style = "texto"
+                self.merge_observations(aluno, cell, response_dict.get(header) or [])
+            elif header in response_dict and response_dict[header]:
                 cell = ws.cell(row=aluno_row, column=col_idx)
 
-                cell.font = Font(name="Arial", size=10)
+                cell.style = "texto"
 
-                if header == "Observações (sem desconto na nota)":
-                    obs_text = "\n".join(f"- {err}" for err in response_dict[header])
-                    existing_value = cell.value or ""
-                    cell.value = f"{existing_value}\n{obs_text}".strip()
-                else:
-                    comment_text = "\n".join(f"- {err}" for err in response_dict[header])
+                comment_text = "\n".join(f"- {err}" for err in response_dict[header])
 
-                    cell.comment = Comment(comment_text, "José Alberto Feijão Tizon")
+                cell.comment = Comment(comment_text, "José Alberto Feijão Tizon")
 
-                    total_deduction = sum(
-                        int(re.search(r"-\s*(\d+)", err).group(1))
-                        for err in response_dict[header]
-                        if re.search(r"-\s*\d+", err)
-                    )
-                    existing_value = cell.value if cell.value else ""
-                    cell.value = f"=MAX(-{total_deduction})"
-                    cell.alignment = Alignment(horizontal="right")
+                total_deduction = sum(
+                    int(re.search(r"-\s*(\d+)", err).group(1))
+                    for err in response_dict[header]
+                    if re.search(r"-\s*\d+", err)
+                )
+                cell.value = f"=MAX(-{total_deduction})"
+                cell.style = "desconto"
+
+    def report_leftover_processes(self):
+        for pid, command, killed in runner.sweep_leftover_processes([self.alunos_path]):
+            print(f"Leftover process {pid} ({command}) {'killed' if killed else 'still running'}")
 
-        wb.save(self.sheet_path)
+    def correct_students(self, headers):
+        progress = 1
+        for aluno in self.alunos_list:
+            if self.aluno is not None and aluno!=self.aluno:
+                continue
+            print(f"Correcting... ({progress}/{len(self.alunos_list)}). Current student: {aluno}")
+            aluno_path = os.path.join(self.alunos_path, aluno)
+            self.clear_logs_file(aluno_path, "auto")
+            self.correct_code(aluno_path)
+            try:
+                self.compile_student_code(aluno_path)
+            except CorrectionFailed:
+                continue
+            finally:
+                progress += 1
+            self.print_log('CORRECAO AUTOMATICA:', aluno_path, tipo_correcao="auto", encoding='utf-8')
+            for testcase in os.listdir(self.testcases_path):
+                self.correct_output(aluno_path, testcase)
+            self.remove_unwanted_files(aluno_path)
+
+    def do_ai_job(self, aluno):
+        aluno_path = os.path.join(self.alunos_path, aluno)
+        code = self.get_student_code(aluno_path)
+        self.clear_logs_file(aluno_path, "ia")
+        return json.loads("\n".join(self.do_ai_correction(aluno_path, code)))
+
+    def run_ai_stage(self, headers):
+        # At most ai_jobs students are asked at a time, and the circuit breaker stops the stage after many failures in a row.
+        # The failed students stay in the queue for the next correction (or one with ai_only)
+        alunos = [
+            aluno for aluno, job in self.ai_queue.items()
+            if job["attempts"] < self.ai_job_max_attempts and (self.aluno is None or aluno == self.aluno)
+        ]
+        if not alunos:
+            return
+        print(f"AI stage: {len(alunos)} students in the queue")
+        with ThreadPoolExecutor(self.ai_jobs) as executor:
+            running = {}
+            while alunos or running:
+                while alunos and len(running) < self.ai_jobs and self.ai_circuit_breaker.allow_request():
+                    aluno = alunos.pop(0)
+                    running[executor.submit(self.do_ai_job, aluno)] = aluno
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                # The sheet is only changed here, in the main thread
+                for future in done:
+                    self.finish_ai_job(running.pop(future), future, headers)
+        if self.ai_circuit_breaker.is_open():
+            print(f"AI stage stopped after {self.ai_circuit_breaker.failures} failed students in a row")
+        left_jobs = len([aluno for aluno, job in self.ai_queue.items() if job["attempts"] < self.ai_job_max_attempts])
+        if left_jobs:
+            print(f"{left_jobs} students left in the AI queue, run again with ai_only=True to resume")
+
+    def finish_ai_job(self, aluno, future, headers):
+        try:
+            response_dict = future.result()
+        except CorrectionFailed:
+            # The code was removed after the automatic correction, there is nothing to ask
+            del self.ai_queue[aluno]
+            return
+        except Exception as e:
+            self.ai_circuit_breaker.record_failure()
+            self.ai_queue[aluno] = {"attempts": self.ai_queue[aluno]["attempts"] + 1, "last_error": str(e)}
+            print(f"AI correction of {aluno} failed: {e}")
+            return
+        self.ai_circuit_breaker.record_success()
+        del self.ai_queue[aluno]
+        self.add_corrections_to_sheet(aluno, response_dict, headers)
+        self.checkpoint_sheet()
 
     def make_correction(self):
         headers = [
@@ -232,31 +494,29 @@ class AbstractCorrector(ABC):
             "Global", "Busca Binária", "Func. Públicas", "fclose/free",
             "Outros", "Observações (sem desconto na nota)"
         ]
-        self.create_correction_sheet(headers)
-        progress = 1
+        # The AI stage alone adds its corrections to the sheet of the automatic correction
+        if (self.merge or self.ai_only) and os.path.isfile(self.sheet_path):
+            self.open_correction_sheet()
+        else:
+            self.create_correction_sheet(headers)
         try:
-            for aluno in self.alunos_list:
-                if self.aluno is not None and aluno!=self.aluno:
-                    continue
-                print(f"Correcting... ({progress}/{len(self.alunos_list)}). Current student: {aluno}")
-                aluno_path = os.path.join(self.alunos_path, aluno)
-                aluno_row = progress + 1
-                self.clear_logs_file(aluno_path, "auto")
-                self.correct_code(aluno_path, aluno_row, headers)
-                try:
-                    self.compile_student_code(aluno_path)
-                except CorrectionFailed:
-                    continue
-                finally:
-                    progress += 1
-                self.print_log('CORRECAO AUTOMATICA:', aluno_path, tipo_correcao="auto", encoding='utf-8')
-                for testcase in os.listdir(self.testcases_path):
-                    self.correct_output(aluno_path, testcase)
-                self.remove_unwanted_files(aluno_path)
+            if not self.ai_only:
+                self.correct_students(headers)
+                # Saved before the AI stage, an AI outage only leaves the students in the AI queue
+                self.save_sheet()
+            if self.use_ai:
+                self.run_ai_stage(headers)
+                if self.ai_cache:
+                    print(f"AI cache: {self.ai_cache.hits} hits, {self.ai_cache.misses} misses")
+                print(f"Refine calls: {self.refines} made, {self.skipped_refines} skipped")
+                print(f"AI usage: {self.ai_usage}")
             print("Correction ended successfully")
         except Exception as e:
             print(f"Correction failed due to error: {e}")
             traceback.print_exc()
+        finally:
+            self.save_sheet()
+            self.report_leftover_processes()
 
 
 
@@ -1,5 +1,5 @@
-def get_correction_criteria():
-    return str({
+def get_correction_criteria_dict():
+    return {
         "Prazo": [],
 
         "Arquivo": [
@@ -103,7 +103,10 @@ def get_correction_criteria():
             "Malloc desnecessário em variáveis em geral",
             "[Outras observações] {Incluir observações curtas}"
         ]
-    })
+    }
+
+def get_correction_criteria():
+    return str(get_correction_criteria_dict())
 
 
 def get_correction_instructions():
@@ -2,9 +2,12 @@ import os
 import re
 import glob
 import json
+import hashlib
 from abstract_corrector import AbstractCorrector, CorrectionFailed
 from corrector_agent import CorrectorAgent
-from criterios_correcao import get_correction_criteria, get_correction_instructions, get_main_prompt, get_refined_prompt
+from rate_limiter import TokenUsage
+from prompt_compaction import compact_code, compact_text, dedupe
+from criterios_correcao import get_correction_criteria_dict, get_correction_instructions, get_main_prompt, get_refined_prompt
 
 class Lab1Corrector(AbstractCorrector):
     def test_cabecalho(self, aluno_path, testcase, output):
@@ -65,24 +68,108 @@ class Lab1Corrector(AbstractCorrector):
         except CorrectionFailed:
             return
 
+    def get_criterion_hash(self, category, items):
+        return hashlib.sha256(json.dumps([category, items], ensure_ascii=False).encode()).hexdigest()
+
+    def get_ai_headers(self):
+        # The columns with criteria for the AI, the others (e.g. Prazo) are filled by hand
+        return [category for category, items in get_correction_criteria_dict().items() if items]
+
     def do_ai_correction(self, aluno_path, student_code):
-        correction_criteria_prompt = get_correction_criteria()
-        correction_instructions_prompt = get_correction_instructions()
-        corrector_agent = CorrectorAgent(aluno_path)
+        # Both requests carry the criteria, the instructions and the code, so they are sent compacted
+        correction_criteria = {category: dedupe(items) for category, items in get_correction_criteria_dict().items()}
+        student_code = compact_code(student_code)
+        code_hash = hashlib.sha256(student_code.encode()).hexdigest()
+        aluno = os.path.basename(aluno_path)
+        # Categories already answered for this code and these criteria are reused, only the others are asked
+        # A new dict, set at the end, the sheet may be saved by the main thread meanwhile
+        stored_results = dict(self.ai_results.get(aluno, {}))
+        results = {}
+        for category, items in correction_criteria.items():
+            stored_result = stored_results.get(category, {})
+            if not self.refresh_ai and stored_result.get("code_hash") == code_hash and stored_result.get("criterion_hash") == self.get_criterion_hash(category, items):
+                results[category] = stored_result["items"]
+        missing_criteria = {category: items for category, items in correction_criteria.items() if category not in results}
+        if results:
+            self.print_log(f"Reaproveitado: {', '.join(results)}", aluno_path, tipo_correcao="ia", encoding='utf-8')
+        if missing_criteria:
+            response_dict = json.loads("\n".join(self.ask_ai_correction(aluno_path, missing_criteria, student_code)))
+            if not isinstance(response_dict, dict):
+                response_dict = {}
+            # A category left out of the answer stays empty in the sheet and is asked again in the next correction
+            for category, items in missing_criteria.items():
+                if isinstance(response_dict.get(category), list):
+                    results[category] = response_dict[category]
+                    stored_results[category] = {
+                        "criterion_hash": self.get_criterion_hash(category, items),
+                        "code_hash": code_hash,
+                        "items": response_dict[category]
+                    }
+        self.ai_results[aluno] = stored_results
+        return json.dumps({category: results[category] for category in correction_criteria if category in results}, ensure_ascii=False, indent=4).splitlines()
+
+    def ask_ai_correction(self, aluno_path, correction_criteria, student_code):
+        correction_criteria_prompt = json.dumps(correction_criteria, ensure_ascii=False)
+        correction_instructions_prompt = compact_text(get_correction_instructions())
+        corrector_agent = CorrectorAgent(aluno_path, cache=self.ai_cache, rate_limiter=self.ai_rate_limiter, backend=self.ai_backend)
+        usage = TokenUsage()
         prompt = get_main_prompt(correction_criteria_prompt, correction_instructions_prompt, student_code)
-        response = corrector_agent.respond(prompt)
-        refined_prompt = get_refined_prompt(correction_criteria_prompt, correction_instructions_prompt, student_code, response)
-        refined_response = corrector_agent.respond(refined_prompt)
+        response = corrector_agent.respond(prompt, usage=usage)
         for line in response:
             self.print_log(line, aluno_path, tipo_correcao="ia", encoding='utf-8')
         self.print_log('', aluno_path, tipo_correcao="ia", encoding='utf-8')
+        # The second request only fixes a first answer that doesn't follow the criteria
+        if self.conditional_refine and not self.get_ai_correction_problems(response, correction_criteria):
+            with self.ai_stats_lock:
+                self.skipped_refines += 1
+            self.add_ai_usage(aluno_path, usage)
+            return response
+        refined_prompt = get_refined_prompt(correction_criteria_prompt, correction_instructions_prompt, student_code, response)
+        refined_response = corrector_agent.respond(refined_prompt, usage=usage)
+        with self.ai_stats_lock:
+            self.refines += 1
         for line in refined_response:
             self.print_log(line, aluno_path, tipo_correcao="ia", encoding='utf-8')
         self.print_log('', aluno_path, tipo_correcao="ia", encoding='utf-8')
+        self.add_ai_usage(aluno_path, usage)
         return refined_response
-    
-
-
 
+    def get_criterion_regex(self, criterion):
+        # Text between {} is replaced by the AI and text between [] is left out, the deduction is checked apart
+        criterion = re.sub(r"\s*\(-[^()]*\)\s*\.?\s*$", "", criterion)
+        pattern = ""
+        for part in re.split(r"(\{[^}]*\}|\[[^\]]*\])", criterion):
+            if part.startswith("{"):
+                pattern += ".+"
+            elif not part.startswith("["):
+                pattern += re.escape(self.normalize_criterion(part)) if part.strip() else r"\s*"
+        return re.compile(pattern.strip() + r"\s*(\(-[^()]*\))?")
 
+    def normalize_criterion(self, criterion):
+        # Stray braces from criteria like "{atributo(s) A,B,C e D} do struct na main}"
+        criterion = criterion.replace("{", "").replace("}", "")
+        return re.sub(r"\s+", " ", criterion).strip().rstrip(".")
 
+    def get_ai_correction_problems(self, response, criteria):
+        # Empty if the response is a dict with every asked category, deductions as (-x) and only the known criteria
+        try:
+            response_dict = json.loads("\n".join(response))
+        except ValueError:
+            return ["Resposta nao e um json valido"]
+        if not isinstance(response_dict, dict):
+            return ["Resposta nao e um dicionario"]
+        problems = [f"Categoria ausente: {category}" for category in criteria if category not in response_dict]
+        problems += [f"Categoria desconhecida: {category}" for category in response_dict if category not in criteria]
+        for category, items in response_dict.items():
+            if category not in criteria:
+                continue
+            if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+                problems.append(f"Categoria {category} nao e uma lista de textos")
+                continue
+            criterion_regexes = [self.get_criterion_regex(criterion) for criterion in criteria[category]]
+            for item in items:
+                if category != "Observações (sem desconto na nota)" and not re.search(r"\(-\s*\d+[^()]*\)\s*\.?$", item.strip()):
+                    problems.append(f"Desconto fora do formato (-x) em {category}: {item}")
+                if not any(regex.fullmatch(self.normalize_criterion(item)) for regex in criterion_regexes):
+                    problems.append(f"Criterio desconhecido em {category}: {item}")
+        return problems
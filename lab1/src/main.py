@@ -1,18 +1,23 @@
-from lab1_corrector import Lab1Corrector
-
-lab_folder_path = "./lab1"
-
-testcases_path = lab_folder_path + "/testcases"
-
-alunos_path = lab_folder_path + "/labs-alunos-t1"
-#alunos_path = lab_folder_path + "/labs-alunos-t2"
-#alunos_path = lab_folder_path + "/labs-teste"
-
-sheet_path = "Planilha.xlsx"
-numero_lab = 1
-
-#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=True)
-corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=False)
-#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=False, aluno='')
-
+from lab1_corrector import Lab1Corrector
+
+lab_folder_path = "./lab1"
+
+testcases_path = lab_folder_path + "/testcases"
+
+alunos_path = lab_folder_path + "/labs-alunos-t1"
+#alunos_path = lab_folder_path + "/labs-alunos-t2"
+#alunos_path = lab_folder_path + "/labs-teste"
+
+sheet_path = "Planilha.xlsx"
+numero_lab = 1
+
+#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=True)
+corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=False)
+#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=False, aluno='')
+#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=True, aluno='', merge=True)
+#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=True, refresh_ai=True)
+#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=True, conditional_refine=True)
+#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=True, ai_only=True)
+#corrector = Lab1Corrector(alunos_path, testcases_path, sheet_path, numero_lab, use_ai=True, ai_jobs=2, ai_job_max_attempts=5)
+
 corrector.make_correction()
\ No newline at end of file
@@ -0,0 +1,53 @@
+import re
+import textwrap
+
+# Strings and chars are matched first, so a "//" or "/*" inside them isn't taken as a comment
+COMMENT_REGEX = re.compile(r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|//[^\n]*|/\*.*?\*/', re.DOTALL)
+
+# About 10000 tokens, longer codes are cut before being sent
+MAX_CODE_SIZE = 40000
+
+def strip_comments(code):
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        # A block comment between two tokens still separates them
+        return "\n" if "\n" in match.group(0) else " "
+    return COMMENT_REGEX.sub(replace, code)
+
+def compact_code(code, max_size=MAX_CODE_SIZE):
+    # Without comments, trailing spaces and blank lines. The indentation stays, it is also corrected
+    lines = [line.rstrip() for line in strip_comments(code).splitlines()]
+    code = "\n".join(line for line in lines if line)
+    if len(code) > max_size:
+        code = code[:max_size] + f"\n// [codigo cortado: {len(code) - max_size} caracteres omitidos]"
+    return code
+
+def normalize_line(line):
+    return re.sub(r"\s+", " ", line).strip().lower()
+
+def dedupe(items):
+    # Keeps the first of the items that only differ by spaces or case
+    seen = set()
+    unique_items = []
+    for item in items:
+        if normalize_line(item) not in seen:
+            seen.add(normalize_line(item))
+            unique_items.append(item)
+    return unique_items
+
+def compact_text(text):
+    # For the prompt templates: without the common indentation, repeated sentences and runs of blank lines
+    lines = [line.rstrip() for line in textwrap.dedent(text).splitlines()]
+    seen = set()
+    compacted_lines = []
+    for line in lines:
+        # Only lines with words are deduplicated, a repeated "}," or "-----" still has a meaning
+        if re.search(r"\w{3}", line):
+            if normalize_line(line) in seen:
+                continue
+            seen.add(normalize_line(line))
+        if not line and (not compacted_lines or not compacted_lines[-1]):
+            continue
+        compacted_lines.append(line)
+    return "\n".join(compacted_lines).strip()
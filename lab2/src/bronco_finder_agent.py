@@ -1,16 +1,19 @@
-import os
-from dotenv import load_dotenv
-from google import genai
+from rate_limiter import estimate_tokens, get_error_code, is_retryable, get_retry_delay
+from llm_backend import create_backend
 from abc import ABC, abstractmethod
 
-load_dotenv()
-
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
+MODEL = "gemini-2.5-flash"
+# Answer of the mock backend (AI_BACKEND=mock) for the prompts it has no recording of
+MOCK_TEXT = "Nenhum problema identificado"
 
 import time
 
 class CorrectorAgent:
+    def __init__(self, rate_limiter=None, backend=None):
+        self.rate_limiter = rate_limiter
+        # Gemini unless another backend is given or AI_BACKEND selects the mock, its SDK is only loaded on the first request
+        self.backend = backend or create_backend(MOCK_TEXT)
+
     def post_process(self, response_text):
         lines = response_text.splitlines()
         start_idx = next((i for i, line in enumerate(lines) if "{" in line), None)
@@ -21,25 +24,32 @@ class CorrectorAgent:
             lines = []
         return lines
     
-    def respond(self, user_input, max_retries=10, delay=10):
-        attempt = 1
-        while attempt < max_retries:
-            try:
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash", 
-                    contents=user_input
-                )
-                
-                return self.post_process(response.text)
+    def handle_failed_attempt(self, error, attempt, max_retries, base_delay, max_delay, key_index):
+        # Raises the error if it can't be retried, otherwise returns how long to wait before the next attempt
+        if not is_retryable(error):
+            print(f"An unexpected error occurred: {error}")
+            raise error
+        if attempt == max_retries:
+            raise RuntimeError(f"All {max_retries} attempts failed, the last one with: {error}") from error
+        delay = get_retry_delay(error, attempt, base_delay, max_delay)
+        if self.rate_limiter and get_error_code(error) == 429:
+            # Only this key cools down, the next attempt goes to a key with quota left (or waits for one)
+            self.rate_limiter.pause(key_index, delay)
+            delay = 0
+        print(f"Attempt {attempt} failed with {get_error_code(error) or type(error).__name__} on key {key_index + 1}. Retrying in {delay:.1f} seconds...")
+        return delay
 
+    def respond(self, user_input, max_retries=10, base_delay=2, max_delay=60):
+        prompt_tokens = estimate_tokens(user_input)
+        for attempt in range(1, max_retries + 1):
+            key_index = attempt % self.backend.num_keys
+            if self.rate_limiter:
+                key_index = self.rate_limiter.acquire(prompt_tokens)
+            try:
+                response = self.backend.generate(MODEL, user_input, key_index)
             except Exception as e:
-                if "503" in str(e) or "UNAVAILABLE" in str(e):
-                    print(f"Attempt {attempt} failed with 503/UNAVAILABLE. Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                    if attempt < 10:
-                        attempt += 1
-                        continue
-                else:
-                    print(f"An unexpected error occurred: {e}")
-                    raise e
-            raise RuntimeError(f"All {max_retries} attempts failed due to 503/UNAVAILABLE errors.")
+                delay = self.handle_failed_attempt(e, attempt, max_retries, base_delay, max_delay, key_index)
+                time.sleep(delay)
+                continue
+
+            return self.post_process(response.text)
@@ -1,11 +1,20 @@
 import os
+import io
+import errno
+import mmap
 import subprocess
 import glob
 import shutil
 import traceback
 import json
 import re
-from bronco_finder_agent import CorrectorAgent
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from bronco_finder_agent import CorrectorAgent, MOCK_TEXT
+from rate_limiter import KeyRateLimiter, CircuitBreaker
+from llm_backend import GeminiBackend, create_backend
+import runner
+from results_db import ResultsDatabase
 
 class CorrectionFailed(Exception):
     def __init__(self, student, error_type, message):
@@ -37,6 +46,12 @@ class Student():
         self.logs = []
         self.num_total_testcases = 0
         self.num_passed_testcases = 0
+        # Testcase name -> runner.RunResult
+        self.run_usages = {}
+        # Testcase name -> (passed, messages)
+        self.testcase_results = {}
+        # Only the codes that passed the file name checks are sent to the AI
+        self.code_checked = False
 
 class Lab2Corrector():
     def __init__(self, dados_lab):
@@ -45,9 +60,32 @@ class Lab2Corrector():
         self.student_errors_path = dados_lab.student_errors_path
         self.numero_lab = dados_lab.numero_lab
         self.skip_passed_labs = dados_lab.skip_passed_labs
-        self.do_bronco_detection = dados_lab.do_bronco_detection
+        # The AI stage alone only drains the queue, so it always has the bronco detection on
+        self.do_bronco_detection = dados_lab.do_bronco_detection or dados_lab.ai_only
+        self.jobs = dados_lab.jobs
+        self.max_output_size = dados_lab.max_output_size
+        self.run_limits = runner.RunLimits(
+            cpu_seconds=dados_lab.run_cpu_limit,
+            address_space=dados_lab.run_memory_limit,
+            file_size=dados_lab.run_output_limit,
+            processes=dados_lab.run_process_limit,
+            core_dumps=dados_lab.run_core_dumps
+        )
+        self.results_db = ResultsDatabase(dados_lab.results_db_path)
+        # The AI requests run after the grading is saved, in the AI stage (also alone with ai_only)
+        self.ai_only = dados_lab.ai_only
+        self.ai_jobs = dados_lab.ai_jobs
+        self.ai_job_max_attempts = dados_lab.ai_job_max_attempts
+        self.ai_circuit_breaker = CircuitBreaker(dados_lab.ai_failure_threshold, dados_lab.ai_breaker_cooldown)
+        self.ai_backend = None
+        self.ai_rate_limiter = None
+        if self.do_bronco_detection:
+            self.ai_backend = create_backend(MOCK_TEXT)
+            # The mock answers (AI_BACKEND=mock) are not limited
+            if isinstance(self.ai_backend, GeminiBackend):
+                # One limit for each API key, shared through a file with the other corrections using the same key
+                self.ai_rate_limiter = KeyRateLimiter(dados_lab.ai_rate_limit_path, self.ai_backend.api_keys)
 
-        self.student = None
         self.error_type_to_correct = None
 
         self.error_files = [
@@ -62,7 +100,6 @@ class Lab2Corrector():
         self.students = self.get_students_list()
 
         self.error_type_to_correct = self.get_error_type_to_correct()
-        self.remove_error_type_txts()
 
     def get_students_list(self):
         students = []
@@ -71,42 +108,33 @@ class Lab2Corrector():
             student_path = os.path.join(self.students_path, folder)
             students.append(Student(student_path))
 
-        for file in self.error_files:
-            error_file_path = os.path.join(self.student_errors_path, file)
-            if not os.path.isfile(error_file_path):
-                continue
-            with open(error_file_path, "r") as f:
-                for line in f:
-                    student_name = line.strip()
-                    if student_name:
-                        for student in students:
-                            if student.name == student_name:
-                                student.error_type = file[:-4]
+        error_types = self.results_db.get_error_types()
+        for student in students:
+            student.error_type = error_types.get(student.name)
         return sorted(students, key=lambda x: x.name)                          
 
     def get_error_type_to_correct(self):
         error_type_to_correct = None
         for file in self.error_files:
-            error_file_path = os.path.join(self.student_errors_path, file)
-            if not os.path.isfile(error_file_path):
+            if not self.results_db.get_students_with_error_type(file[:-4]):
                 continue
             error_type_to_correct = file[:-4]
             break
         return error_type_to_correct
             
-    def clear_logs_file(self):
-        logs_correcao_path = self.student.path + "/logs_correcao_auto.txt"
+    def clear_logs_file(self, student):
+        logs_correcao_path = student.path + "/logs_correcao_auto.txt"
         open(logs_correcao_path, "w").close()
 
-    def log_errors(self, encoding):
-        logs_correcao_path = self.student.path + "/logs_correcao_auto.txt"
+    def log_errors(self, student, encoding):
+        logs_correcao_path = student.path + "/logs_correcao_auto.txt"
         with open(logs_correcao_path, "a", encoding=encoding) as logs:
-            print(f"{self.student.error_type}\n", file=logs)                
-            for error_log in self.student.logs:
+            print(f"{student.error_type}\n", file=logs)                
+            for error_log in student.logs:
                 print(error_log, file=logs)
 
-    def add_log(self, message, encoding):
-        logs_correcao_path = self.student.path + "/logs_correcao_auto.txt"
+    def add_log(self, student, message, encoding):
+        logs_correcao_path = student.path + "/logs_correcao_auto.txt"
         with open(logs_correcao_path, "a", encoding=encoding) as logs:
             print(message, file=logs)                
 
@@ -131,128 +159,144 @@ class Lab2Corrector():
             os.makedirs(new_folder_path, exist_ok=True)
             shutil.move(file_path, os.path.join(new_folder_path, filename))  
 
-    def remove_outputs_folder(self):
-        outputs_path = os.path.join(self.student.path, "outputs")
+    def remove_outputs_folder(self, student):
+        outputs_path = os.path.join(student.path, "outputs")
         if os.path.exists(outputs_path) and os.path.isdir(outputs_path):
             shutil.rmtree(outputs_path)
 
-    def remove_unwanted_files(self):
-        for f in os.listdir(self.student.path):
-            full_path = os.path.join(self.student.path, f)
+    def remove_unwanted_files(self, student):
+        for f in os.listdir(student.path):
+            full_path = os.path.join(student.path, f)
             if f == "a.out":
                 os.remove(full_path)
             elif f.endswith(".txt") and not f.startswith("logs_correcao"):
                 os.remove(full_path)
 
-    def remove_error_type_txts(self):
-        for file in self.error_files:
-            error_file_path = os.path.join(self.student_errors_path, file)
-            if os.path.isfile(error_file_path):
-                os.remove(error_file_path)
-
-    def create_error_type_txts(self):
-        for student in self.students:
-            error_file = f"{student.error_type}.txt"
-            error_file_path = os.path.join(self.student_errors_path, error_file)
-            with open(error_file_path, "a") as file:
-                file.write(student.name + "\n")
-
-    def get_and_handle_output(self, testcase):
-        output_path = glob.glob(f'{self.student.path}/Lab*.txt')
+    def get_source_hash(self, student):
+        source_hash = hashlib.sha256()
+        for source_path in runner.expand(student.path, 'Lab*.cpp'):
+            with open(source_path, "rb") as source_file:
+                source_hash.update(hashlib.sha256(source_file.read()).digest())
+        return source_hash.hexdigest()
+
+    def save_results(self, students):
+        source_hashes = {student.name: self.get_source_hash(student) for student in students}
+        self.results_db.save_students(students, source_hashes)
+        # The text files are only an export now, the database is what the next run reads
+        self.results_db.export_error_type_txts(self.student_errors_path, self.error_files)
+
+    def archive_output(self, output_path, final_output_path):
+        # A rename on the same filesystem, a copy only across devices (e.g. with the execution folder in RAM)
+        try:
+            os.replace(output_path, final_output_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy(output_path, final_output_path)
+            os.remove(output_path)
+
+    def split_output_lines(self, data, encoding):
+        lines = []
+        for raw_line in iter(data.readline, b""):
+            line = str(raw_line, encoding)
+            if "\r" in line:
+                # newline=None splits the lines the same way a file opened in text mode does
+                lines.extend(io.StringIO(line, newline=None).readlines())
+            else:
+                lines.append(line)
+        return lines
+
+    def read_output_lines(self, output_path):
+        # Split on a memory-mapped view of the archived output and decoded line by line, so only the list of lines is built
+        with open(output_path, 'rb') as output_file:
+            if os.fstat(output_file.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(output_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                try:
+                    return self.split_output_lines(data, 'utf-8')
+                except UnicodeDecodeError:
+                    # The whole output is read again as latin1, not only the lines that aren't utf-8
+                    data.seek(0)
+                    return self.split_output_lines(data, 'latin1')
+
+    def get_and_handle_output(self, student, testcase):
+        output_path = glob.glob(f'{student.path}/Lab*.txt')
         if not output_path:
-            raise FailedTestcaseError(self.student, "Nao criou o arquivo txt de saida\n")
-        output_folder = os.path.join(self.student.path, 'outputs')
+            raise FailedTestcaseError(student, "Nao criou o arquivo txt de saida\n")
+        output_folder = os.path.join(student.path, 'outputs')
         os.makedirs(output_folder, exist_ok=True)
         final_output_path = os.path.join(output_folder, f"{testcase}.txt")
-        shutil.copy(output_path[0], final_output_path)
-        os.remove(output_path[0])
-        try:
-            with open(final_output_path, encoding='utf-8') as output_file:
-                return output_file.readlines()
-        except UnicodeDecodeError:           
-            with open(final_output_path, encoding='latin1') as output_file:
-                return output_file.readlines()
+        self.archive_output(output_path[0], final_output_path)
+        if os.path.getsize(final_output_path) > self.max_output_size:
+            raise FailedTestcaseError(student, f"Output maior que o limite de {self.max_output_size} bytes no caso teste {testcase}\n")
+        return self.read_output_lines(final_output_path)
         
-    def get_student_code(self):
-        cpp_path = glob.glob(f'{self.student.path}/Lab*.cpp')
+    def get_student_code(self, student):
+        cpp_path = glob.glob(f'{student.path}/Lab*.cpp')
         if not cpp_path:
-            raise WrongFilePathError(self.student, "Nao enviou o arquivo .cpp\n")
+            raise WrongFilePathError(student, "Nao enviou o arquivo .cpp\n")
         with open(cpp_path[0], encoding='latin-1') as cpp_file:
             return cpp_file.read()
 
-    def compile_student_code(self):
-        if os.path.isdir(self.student.path):
-            cpp_path = os.path.join(f'{self.student.path}/Lab*.cpp')
+    def compile_student_code(self, student):
+        if os.path.isdir(student.path):
+            cpp_paths = runner.expand(student.path, 'Lab*.cpp')
             try:
-                result = subprocess.run(
-                    f'gcc {cpp_path} -o {self.student.path}/a.out',
-                    shell=True, 
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.PIPE,
-                    timeout=5
-                )
+                result = runner.compile_code('gcc', [], cpp_paths, os.path.join(student.path, 'a.out'), timeout=5)
                 if result.returncode == 0 and result.stderr:
-                    self.add_log(f"WARNINGS NA COMPILACAO:\n{result.stderr.decode('utf-8', errors='replace')}", encoding="utf-8")
+                    self.add_log(student, f"WARNINGS NA COMPILACAO:\n{result.stderr.decode('utf-8', errors='replace')}", encoding="utf-8")
             except subprocess.CalledProcessError as e:
-                raise CompilationError(self.student, f"Codigo de saida: {e.returncode}\n")
+                raise CompilationError(student, f"Codigo de saida: {e.returncode}\n")
             except subprocess.TimeoutExpired:
-                raise CompilationError(self.student, f"Tempo limite de compilacao excedido.")
+                raise CompilationError(student, f"Tempo limite de compilacao excedido.")
             except Exception as e:
-                raise CompilationError(self.student, f"Ocorreu um erro inesperado na compilacao: {e}\n")
+                raise CompilationError(student, f"Ocorreu um erro inesperado na compilacao: {e}\n")
 
-    def run_student_code(self, testcase):
+    def run_student_code(self, student, testcase):
         testcase_path = os.path.join(self.testcases_path, testcase)
         input_file = os.path.join(testcase_path, f"entrada{self.numero_lab}.txt")
-        shutil.copy(input_file, self.student.path)
+        shutil.copy(input_file, student.path)
 
         # Apenas pro lab 2
         input_file = os.path.join(testcase_path, f"Entrada{self.numero_lab}.txt")
-        shutil.copy(input_file, self.student.path)
+        shutil.copy(input_file, student.path)
 
         try:
-            subprocess.run(
-                './a.out', 
-                cwd=self.student.path, 
-                shell=True, 
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                timeout=5
-            )
-        except subprocess.CalledProcessError as e:
-            raise FailedTestcaseError(self.student, f"Erro na execucao do caso teste {testcase}.\nCodigo de saida: {e.returncode}\n")
-        except subprocess.TimeoutExpired:
-            raise FailedTestcaseError(self.student, f"Tempo limite de execucao do caso teste {testcase} excedido")
+            result = runner.run(['./a.out'], cwd=student.path, timeout=5, limits=self.run_limits)
         except Exception as e:
-            raise FailedTestcaseError(self.student, f"Ocorreu um erro inesperado na execucao do caso teste {testcase}: {e}\n")
+            raise FailedTestcaseError(student, f"Ocorreu um erro inesperado na execucao do caso teste {testcase}: {e}\n")
+        student.run_usages[testcase] = result
 
-    def check_fopen_path(self, student_code):
+        if result.timed_out:
+            raise FailedTestcaseError(student, f"Tempo limite de execucao do caso teste {testcase} excedido")
+        if result.returncode != 0:
+            raise FailedTestcaseError(student, f"Erro na execucao do caso teste {testcase}.\nCodigo de saida: {result.returncode}\n")
+
+    def check_fopen_path(self, student, student_code):
         pattern_entrada = fr'fopen\s*\(\s*"[Ee]ntrada{self.numero_lab}\.txt"\s*,\s*".*?"\s*\)'
         pattern_saida = fr'fopen\s*\(\s*"Lab{self.numero_lab}_[a-zA-Z0-9_]+\.txt"\s*,\s*".*?"\s*\)'
         nome_entrada_correto = re.search(pattern_entrada, student_code) is not None
         nome_saida_correto = re.search(pattern_saida, student_code) is not None
         if not nome_entrada_correto or not nome_saida_correto:
-            raise WrongFilePathError(self.student, "Erro no nome dos arquivos de entrada ou saída\n")
+            raise WrongFilePathError(student, "Erro no nome dos arquivos de entrada ou saída\n")
 
-    def correct_code(self):
-        code = self.get_student_code()
-        self.check_fopen_path(code)
-        if self.detect_bronco:
-            self.detect_bronco(code)
+    def correct_code(self, student):
+        code = self.get_student_code(student)
+        self.check_fopen_path(student, code)
+        student.code_checked = True
         
-    def correct_output(self, testcase):
-        self.run_student_code(testcase)
-        output = self.get_and_handle_output(testcase)
-        self.test_formatacao(testcase, output)
-        self.compare_with_testcase(testcase, output)
+    def correct_output(self, student, testcase):
+        self.run_student_code(student, testcase)
+        output = self.get_and_handle_output(student, testcase)
+        self.test_formatacao(student, testcase, output)
+        self.compare_with_testcase(student, testcase, output)
 
-    def test_formatacao(self, testcase, output):
+    def test_formatacao(self, student, testcase, output):
         linhas = [linha.rstrip('\n') for linha in output] 
 
         if len(linhas) < 4:
             raise OutputFormattingError(
-                self.student,
+                student,
                 f"Output vazio no caso teste {testcase}"
             )
 
@@ -260,27 +304,27 @@ class Lab2Corrector():
 
         if not re.fullmatch(r'\s*[-=]+\s*', linhas[pos]):
             raise OutputFormattingError(
-                self.student,
+                student,
                 f"Cabecalho nao tem exatamente 3 linhas no caso teste {testcase}"
             )
         pos += 1
 
         if pos >= len(linhas) or [w.upper() for w in linhas[pos].split()] != ["FLIGHT", "FROM"]:
-            raise OutputFormattingError(self.student, f"Linha 'FLIGHT FROM' ausente no caso teste {testcase}")
+            raise OutputFormattingError(student, f"Linha 'FLIGHT FROM' ausente no caso teste {testcase}")
         pos += 1
 
         if pos >= len(linhas) or linhas[pos].strip() != "":
-            raise OutputFormattingError(self.student, f"Faltando linha em branco após 'FLIGHT FROM' no caso teste {testcase}")
+            raise OutputFormattingError(student, f"Faltando linha em branco após 'FLIGHT FROM' no caso teste {testcase}")
         pos += 1
 
         while pos < len(linhas) and linhas[pos].strip() != "":
             campos = linhas[pos].split()
             if len(campos) < 2 or not campos[0].isdigit():
-                raise OutputFormattingError(self.student, f"Bloco de voos autorizados inválido no caso teste {testcase}")
+                raise OutputFormattingError(student, f"Bloco de voos autorizados inválido no caso teste {testcase}")
             pos += 1
 
         if pos >= len(linhas) or linhas[pos].strip() != "":
-            raise OutputFormattingError(self.student, f"Faltando linha em branco após bloco de voos autorizados no caso teste {testcase}")
+            raise OutputFormattingError(student, f"Faltando linha em branco após bloco de voos autorizados no caso teste {testcase}")
         pos += 1
 
         linha = [w.upper() for w in linhas[pos]
@@ -290,10 +334,10 @@ class Lab2Corrector():
                 .split()]
 
         if pos >= len(linhas) or linha != ["SITUACAO", "DA", "FILA"]:
-            raise OutputFormattingError(self.student, f"Linha 'Situacao da fila' ausente no caso teste {testcase}")
+            raise OutputFormattingError(student, f"Linha 'Situacao da fila' ausente no caso teste {testcase}")
         pos += 1
 
-    def compare_with_testcase(self, testcase, output):
+    def compare_with_testcase(self, student, testcase, output):
         linhas = [linha.rstrip('\n') for linha in output] 
 
         student_authorized_flights = []
@@ -340,24 +384,24 @@ class Lab2Corrector():
         with open(answers_path, "r", encoding="utf-8") as answers_file:
             answers = json.load(answers_file)
         if student_authorized_flights != answers["ordem_voos"]["authorized"]:
-            # print(self.student.name)
+            # print(student.name)
             # print(student_authorized_flights, answers["ordem_voos"]["authorized"])
-            raise FailedTestcaseError(self.student, f"Falhou no caso teste {testcase}: ordem das viagens AUTORIZADAS errada")
+            raise FailedTestcaseError(student, f"Falhou no caso teste {testcase}: ordem das viagens AUTORIZADAS errada")
         if answers["ordem_voos"]["pending"]:
             if student_pending_flights != answers["ordem_voos"]["pending"]:
-                raise FailedTestcaseError(self.student, f"Falhou no caso teste {testcase}: ordem das viagens PENDENTES errada")
+                raise FailedTestcaseError(student, f"Falhou no caso teste {testcase}: ordem das viagens PENDENTES errada")
             if student_flight_origins != answers["flight_origins"]:
-                raise FailedTestcaseError(self.student, f"Falhou no caso teste {testcase}: DESTINO das viagens está errado")
+                raise FailedTestcaseError(student, f"Falhou no caso teste {testcase}: DESTINO das viagens está errado")
         else:
             if not student_pending_flights:
-                raise FailedTestcaseError(self.student, f"Falhou no caso teste {testcase}: sem mensagem de PENDENTES VAZIA")
+                raise FailedTestcaseError(student, f"Falhou no caso teste {testcase}: sem mensagem de PENDENTES VAZIA")
             student_filtered = {k: v for k, v in student_flight_origins.items()
                     if str(k).isdigit() and len(str(k)) == 4}
             if student_filtered != answers["flight_origins"]:
-                raise FailedTestcaseError(self.student, f"Falhou no caso teste {testcase}: DESTINO das viagens está errado")
+                raise FailedTestcaseError(student, f"Falhou no caso teste {testcase}: DESTINO das viagens está errado")
 
-    def detect_bronco(self, code):
-        corrector_agent = CorrectorAgent()
+    def detect_bronco(self, student, code):
+        corrector_agent = CorrectorAgent(rate_limiter=self.ai_rate_limiter, backend=self.ai_backend)
         
         generic_prompt = '''
         **Sua função principal**: Você irá identificar no código do aluno processos que tornem o código repetitivo ou que realizam operações
@@ -404,54 +448,147 @@ class Lab2Corrector():
 
         response = corrector_agent.respond(prompt)
         
-        logs_bronco_path = self.student.path + "/logs_correcao_bronco.txt"
+        logs_bronco_path = student.path + "/logs_correcao_bronco.txt"
         with open(logs_bronco_path, "w") as logs:
             for line in response:
                 print(line, file=logs)                
 
-    def make_student_correction(self):
+    def queue_ai_jobs(self, students):
+        if not self.do_bronco_detection:
+            return
+        self.results_db.queue_ai_jobs([student.name for student in students if student.code_checked])
+        # A job left by an earlier correction is dropped once the code doesn't pass the checks anymore
+        for student in students:
+            if not student.code_checked:
+                self.results_db.remove_ai_job(student.name)
+
+    def do_ai_job(self, student):
+        self.detect_bronco(student, self.get_student_code(student))
+
+    def run_ai_stage(self):
+        # Drains the AI queue of the results database after the grading, each bronco log is written as its answer arrives.
+        # The failed students stay in the queue for the next stage (ai_only or the next correction)
+        jobs = [
+            Student(os.path.join(self.students_path, name))
+            for name, attempts in self.results_db.get_ai_jobs()
+            if attempts < self.ai_job_max_attempts
+        ]
+        if not jobs:
+            return
+        print(f"AI stage: {len(jobs)} students in the queue")
+        with ThreadPoolExecutor(self.ai_jobs) as executor:
+            running = {}
+            while jobs or running:
+                while jobs and len(running) < self.ai_jobs and self.ai_circuit_breaker.allow_request():
+                    student = jobs.pop(0)
+                    running[executor.submit(self.do_ai_job, student)] = student
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                # The database is only used here, in the main thread
+                for future in done:
+                    self.finish_ai_job(running.pop(future), future)
+        if self.ai_circuit_breaker.is_open():
+            print(f"AI stage stopped after {self.ai_circuit_breaker.failures} failed students in a row")
+        left_jobs = len([name for name, attempts in self.results_db.get_ai_jobs() if attempts < self.ai_job_max_attempts])
+        if left_jobs:
+            print(f"{left_jobs} students left in the AI queue, run again with ai_only to resume")
+
+    def finish_ai_job(self, student, future):
+        try:
+            future.result()
+        except WrongFilePathError:
+            # The code was removed after the grading, there is nothing to ask
+            self.results_db.remove_ai_job(student.name)
+            return
+        except Exception as e:
+            self.ai_circuit_breaker.record_failure()
+            self.results_db.fail_ai_job(student.name, str(e))
+            print(f"AI request of {student.name} failed: {e}")
+            return
+        self.ai_circuit_breaker.record_success()
+        self.results_db.remove_ai_job(student.name)
+
+    def make_ai_correction(self):
+        try:
+            self.run_ai_stage()
+            print("AI correction ended successfully")
+        except Exception as e:
+            print(f"AI correction failed due to error: {e}")
+            traceback.print_exc()
+
+    def make_student_correction(self, student):
         try:
-            self.correct_code()
-            self.compile_student_code()
+            self.correct_code(student)
+            self.compile_student_code(student)
         except (CompilationError, WrongFilePathError):
             return
-        self.add_log(f"\n{"-"*25}\nRESULTADOS CASOS TESTE:\n{"-"*25}\n", encoding="utf-8")
+        self.add_log(student, f"\n{"-"*25}\nRESULTADOS CASOS TESTE:\n{"-"*25}\n", encoding="utf-8")
         for testcase in os.listdir(self.testcases_path):
+            num_logs = len(student.logs)
             try:
-                self.correct_output(testcase)
-                self.student.num_passed_testcases += 1
+                self.correct_output(student, testcase)
+                student.num_passed_testcases += 1
             except (FailedTestcaseError, FailedTestcaseError, OutputFormattingError):
-                continue
-        if not self.student.logs:
-            self.student.error_type = "NO-ERRORS"
+                pass
+            student.testcase_results[testcase] = (len(student.logs) == num_logs, student.logs[num_logs:])
+        if not student.logs:
+            student.error_type = "NO-ERRORS"
         
 
+    def correct_student(self, student):
+        self.clear_logs_file(student)
+        self.remove_outputs_folder(student)
+        self.make_student_correction(student)
+        self.remove_unwanted_files(student)
+        self.add_log(student, f"\n{"-"*25}\nLOGS ERROS:\n{"-"*25}\n", encoding="utf-8")
+        self.log_errors(student, encoding="utf-8")
+        return student
+
+    def correct_students(self, students_to_correct):
+        if self.jobs == 1:
+            for progress, student in enumerate(students_to_correct, start=1):
+                print(f"Correcting... ({progress}/{len(students_to_correct)}). Current student: {student.name }")
+                self.correct_student(student)
+            return
+
+        # Each worker gets a copy of the student, so the corrected ones are gathered back in the original order
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(self.correct_student, student): student for student in students_to_correct}
+            for progress, future in enumerate(as_completed(futures), start=1):
+                print(f"Corrected ({progress}/{len(students_to_correct)}). Student: {futures[future].name}")
+            corrected_students = {student.name: future.result() for future, student in futures.items()}
+        self.students = [corrected_students.get(student.name, student) for student in self.students]
+
+    def report_leftover_processes(self):
+        for pid, command, killed in runner.sweep_leftover_processes([self.students_path]):
+            print(f"Leftover process {pid} ({command}) {'killed' if killed else 'still running'}")
+
     def make_correction(self):
-        progress = 1
         try:
             for student in self.students:
                 if student.error_type is None:
                     self.skip_passed_labs = False
                     break
             if self.skip_passed_labs:
-                students_to_correct = [student for student in self.students if student.error_type == self.error_type_to_correct]
+                names_to_correct = self.results_db.get_students_with_error_type(self.error_type_to_correct)
+                students_to_correct = [student for student in self.students if student.name in names_to_correct]
             else:
                 students_to_correct = self.students
-            for student in students_to_correct:
-                self.student = student
-                print(f"Correcting... ({progress}/{len(students_to_correct)}). Current student: {student.name }")
-                progress += 1
-                self.clear_logs_file()
-                self.remove_outputs_folder()
-                self.make_student_correction()
-                self.remove_unwanted_files()
-                self.add_log(f"\n{"-"*25}\nLOGS ERROS:\n{"-"*25}\n", encoding="utf-8")
-                self.log_errors(encoding="utf-8")
-            self.create_error_type_txts()
+            self.correct_students(students_to_correct)
+            corrected_names = {student.name for student in students_to_correct}
+            corrected_students = [student for student in self.students if student.name in corrected_names]
+            self.save_results(corrected_students)
+            # The grading is already saved, an AI outage only leaves the students in the AI queue
+            self.queue_ai_jobs(corrected_students)
+            if self.do_bronco_detection:
+                self.run_ai_stage()
             print("Correction ended successfully")
         except Exception as e:
             print(f"Correction failed due to error: {e}")
             traceback.print_exc()
+        finally:
+            self.report_leftover_processes()
 
 
 
@@ -5,6 +5,9 @@ class DadosLab:
         self.lab_folder_path = "./lab2"
         self.testcases_path = self.lab_folder_path + "/testcases"
         self.student_errors_path = self.lab_folder_path + "/erros-alunos"
+        self.results_db_path = self.lab_folder_path + "/resultados.sqlite3"
+        # Requests and tokens per minute of each API key, shared with the other corrections using the same key
+        self.ai_rate_limit_path = self.lab_folder_path + "/limite-ia.json"
 
         #self.students_path = self.lab_folder_path + "/labs-alunos-t1"
         #self.students_path = self.lab_folder_path + "/labs-alunos-t2"
@@ -18,8 +21,40 @@ class DadosLab:
         #self.do_bronco_detection = True
         self.do_bronco_detection = False
 
-
-corrector = Lab2Corrector(DadosLab())
-
-#corrector.make_correction(skip_passed_labs=False)
-corrector.make_correction()
\ No newline at end of file
+        # Only resumes the AI queue left by earlier corrections, without correcting again
+        #self.ai_only = True
+        self.ai_only = False
+
+        # The AI stage runs after the grading is saved, with ai_jobs requests at a time. A student stays in the queue
+        # for ai_job_max_attempts stages, and the stage stops after ai_failure_threshold failed students in a row,
+        # until ai_breaker_cooldown seconds have passed
+        self.ai_jobs = 4
+        self.ai_job_max_attempts = 3
+        self.ai_failure_threshold = 5
+        self.ai_breaker_cooldown = 300
+
+        # Number of students corrected in parallel
+        self.jobs = 1
+
+        # Outputs bigger than this (in bytes) fail the testcase without being read
+        self.max_output_size = 64 * 1024 * 1024
+
+        # Limits applied to each run of the student code (timeout of 5 seconds), None for no limit
+        self.run_cpu_limit = 6
+        self.run_memory_limit = 2 * 1024 * 1024 * 1024
+        # Max size of each file written, so an endless output can't fill the disk
+        self.run_output_limit = 64 * 1024 * 1024
+        # Counts every process of the user running the correction, not only the student ones
+        self.run_process_limit = None
+        self.run_core_dumps = False
+
+
+if __name__ == "__main__":
+    dados_lab = DadosLab()
+    corrector = Lab2Corrector(dados_lab)
+
+    #corrector.make_correction(skip_passed_labs=False)
+    if dados_lab.ai_only:
+        corrector.make_ai_correction()
+    else:
+        corrector.make_correction()
\ No newline at end of file
@@ -0,0 +1,247 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import random
+import asyncio
+import threading
+
+# HTTP codes worth asking again, anything else (bad request, invalid key, ...) fails right away
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_STATUSES = {"UNAVAILABLE", "RESOURCE_EXHAUSTED", "DEADLINE_EXCEEDED", "INTERNAL"}
+
+class RateLimiter():
+    # Token buckets for requests and tokens per minute. The state is in a locked file,
+    # so every thread and process using the same file shares the same limits
+    def __init__(self, state_path, requests_per_minute=10, tokens_per_minute=250000):
+        self.state_path = state_path
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+
+    def try_acquire(self, tokens):
+        # Returns 0 if the request can be made now, or how many seconds to wait before trying again
+        # A prompt bigger than the whole bucket would never fit, it only has to wait for a full one
+        tokens = min(tokens, self.tokens_per_minute)
+        with open(self.state_path, "a+") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            try:
+                state = json.loads(state_file.read())
+            except ValueError:
+                state = {}
+            now = time.time()
+            elapsed = now - state.get("updated_at", now)
+            requests = min(self.requests_per_minute, state.get("requests", self.requests_per_minute) + elapsed * self.requests_per_minute / 60)
+            available_tokens = min(self.tokens_per_minute, state.get("tokens", self.tokens_per_minute) + elapsed * self.tokens_per_minute / 60)
+            paused_until = state.get("paused_until", 0)
+
+            wait_time = max(
+                paused_until - now,
+                (1 - requests) * 60 / self.requests_per_minute,
+                (tokens - available_tokens) * 60 / self.tokens_per_minute,
+                0
+            )
+            if wait_time == 0:
+                requests -= 1
+                available_tokens -= tokens
+            state = {"requests": requests, "tokens": available_tokens, "updated_at": now, "paused_until": paused_until}
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+        return wait_time
+
+    def acquire(self, tokens):
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+    async def acquire_async(self, tokens):
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time == 0:
+                return
+            await asyncio.sleep(wait_time)
+
+    def pause(self, seconds):
+        # After a quota error, every user of the limiter waits, not only the request that got it
+        with open(self.state_path, "a+") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            try:
+                state = json.loads(state_file.read())
+            except ValueError:
+                state = {}
+            state["paused_until"] = max(state.get("paused_until", 0), time.time() + seconds)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+
+class KeyRateLimiter():
+    # One RateLimiter for each API key, each request goes to the next key with quota left
+    def __init__(self, state_path, api_keys, requests_per_minute=10, tokens_per_minute=250000):
+        base_path, extension = os.path.splitext(state_path)
+        # The state files are named after a hash of the key, so reordering the keys keeps their state
+        self.rate_limiters = [
+            RateLimiter(f"{base_path}-{hashlib.sha256(api_key.encode()).hexdigest()[:8]}{extension}", requests_per_minute, tokens_per_minute)
+            for api_key in api_keys
+        ]
+        # Not locked, two threads getting the same start only makes the round-robin a bit uneven
+        self.next_key = 0
+
+    def try_acquire(self, tokens):
+        # Returns the index of the key to use and 0, or None and how many seconds until a key has quota again
+        start = self.next_key
+        self.next_key += 1
+        wait_times = []
+        for offset in range(len(self.rate_limiters)):
+            key_index = (start + offset) % len(self.rate_limiters)
+            wait_time = self.rate_limiters[key_index].try_acquire(tokens)
+            if wait_time == 0:
+                return key_index, 0
+            wait_times.append(wait_time)
+        return None, min(wait_times)
+
+    def acquire(self, tokens):
+        while True:
+            key_index, wait_time = self.try_acquire(tokens)
+            if key_index is not None:
+                return key_index
+            time.sleep(wait_time)
+
+    async def acquire_async(self, tokens):
+        while True:
+            key_index, wait_time = self.try_acquire(tokens)
+            if key_index is not None:
+                return key_index
+            await asyncio.sleep(wait_time)
+
+    def pause(self, key_index, seconds):
+        self.rate_limiters[key_index].pause(seconds)
+
+def estimate_tokens(prompt):
+    # About 4 characters per token, counting them exactly would take another request
+    return len(prompt) // 4 + 1
+
+class CircuitBreaker():
+    # Stops the AI requests after failure_threshold failed ones in a row (e.g. an outage or the quota is over).
+    # After cooldown seconds one more is let through, a success closes it and a failure opens it again
+    def __init__(self, failure_threshold=5, cooldown=300):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow_request(self):
+        if self.opened_at is None:
+            return True
+        if time.time() - self.opened_at < self.cooldown:
+            return False
+        self.opened_at = None
+        self.failures = self.failure_threshold - 1
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+class TokenUsage():
+    # Tokens and time spent on the AI requests of one student, or of the whole correction
+    def __init__(self):
+        self.requests = 0
+        self.cached_requests = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.latency = 0
+        self.lock = threading.Lock()
+
+    # The lock can't be sent to the --jobs workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_cached(self):
+        with self.lock:
+            self.cached_requests += 1
+
+    def add_response(self, response, estimated_prompt_tokens, latency):
+        # The counts reported by the API, or the estimates when the response doesn't have them
+        usage_metadata = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage_metadata, "prompt_token_count", None) or estimated_prompt_tokens
+        response_tokens = getattr(usage_metadata, "candidates_token_count", None) or estimate_tokens(response.text or "")
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.response_tokens += response_tokens
+            self.latency += latency
+
+    def add(self, usage):
+        with self.lock:
+            self.requests += usage.requests
+            self.cached_requests += usage.cached_requests
+            self.prompt_tokens += usage.prompt_tokens
+            self.response_tokens += usage.response_tokens
+            self.latency += usage.latency
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests ({self.cached_requests} cached), "
+            f"{self.prompt_tokens} prompt tokens, {self.response_tokens} response tokens, {self.latency:.1f}s"
+        )
+
+def get_error_code(error):
+    return getattr(error, "code", None)
+
+def is_retryable(error):
+    code = get_error_code(error)
+    if isinstance(code, int):
+        return code in RETRYABLE_CODES
+    if getattr(error, "status", None) in RETRYABLE_STATUSES:
+        return True
+    # Connection errors and timeouts from the http client, before any response
+    if isinstance(error, (ConnectionError, TimeoutError)) or type(error).__module__.split(".")[0] in ("httpx", "httpcore", "aiohttp"):
+        return True
+    return "503" in str(error) or "UNAVAILABLE" in str(error)
+
+def get_retry_after(error):
+    # Seconds the server asked to wait, from the Retry-After header or the RetryInfo in the error body
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []):
+            match = re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", "")))
+            if match:
+                return float(match.group(1))
+    return None
+
+def get_retry_delay(error, attempt, base_delay, max_delay):
+    # Exponential backoff with full jitter, so many waiting requests don't all come back at once
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, base_delay)
+    return delay
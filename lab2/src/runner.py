@@ -0,0 +1,298 @@
+import os
+import glob
+import shutil
+import signal
+import resource
+import select
+import time
+import hashlib
+import threading
+import subprocess
+
+# The ru_maxrss of a process forked from python also counts the memory python had when it forked, which is more
+# than most student codes use. So the student code is forked from this small program, that writes the ru_maxrss
+# of it to the file descriptor given as its first argument and exits the same way it did. The rlimits are also
+# set here, between fork and exec, since a preexec_fn can deadlock while the correction has other threads.
+# Arguments: fd, number of limits, (resource, soft, hard) of each limit, command
+MEMORY_WRAPPER_SOURCE = r'''
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/resource.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+int main(int argc, char **argv) {
+    int fd = atoi(argv[1]);
+    int num_limits = atoi(argv[2]);
+    char **command = argv + 3 + 3 * num_limits;
+    pid_t pid = fork();
+    if (pid < 0)
+        return 127;
+    if (pid == 0) {
+        close(fd);
+        for (int i = 0; i < num_limits; i++) {
+            char **limit_args = argv + 3 + 3 * i;
+            struct rlimit limit = {strtoull(limit_args[1], NULL, 10), strtoull(limit_args[2], NULL, 10)};
+            if (setrlimit(atoi(limit_args[0]), &limit) < 0)
+                _exit(127);
+        }
+        execvp(command[0], command);
+        _exit(127);
+    }
+    int status;
+    struct rusage usage;
+    if (wait4(pid, &status, 0, &usage) < 0)
+        return 127;
+    dprintf(fd, "%ld\n", usage.ru_maxrss);
+    if (WIFSIGNALED(status)) {
+        signal(WTERMSIG(status), SIG_DFL);
+        raise(WTERMSIG(status));
+    }
+    return WEXITSTATUS(status);
+}
+'''
+
+memory_wrapper_path = None
+memory_wrapper_lock = threading.Lock()
+
+class RunLimits():
+    def __init__(self, cpu_seconds=None, address_space=None, file_size=None, processes=None, core_dumps=False):
+        self.cpu_seconds = cpu_seconds
+        self.address_space = address_space
+        self.file_size = file_size
+        # RLIMIT_NPROC counts every process of the user, not only the ones started by the student (and the memory wrapper)
+        self.processes = processes
+        self.core_dumps = core_dumps
+
+    def get_rlimits(self):
+        # (resource, soft, hard) of each limit
+        rlimits = []
+        if self.cpu_seconds is not None:
+            rlimits.append((resource.RLIMIT_CPU, self.cpu_seconds, self.cpu_seconds + 1))
+        if self.address_space is not None:
+            rlimits.append((resource.RLIMIT_AS, self.address_space, self.address_space))
+        if self.file_size is not None:
+            rlimits.append((resource.RLIMIT_FSIZE, self.file_size, self.file_size))
+        if self.processes is not None:
+            rlimits.append((resource.RLIMIT_NPROC, self.processes, self.processes))
+        if not self.core_dumps:
+            rlimits.append((resource.RLIMIT_CORE, 0, 0))
+        return rlimits
+
+    def get_wrapper_args(self):
+        rlimits = self.get_rlimits()
+        return [str(len(rlimits))] + [str(value) for rlimit in rlimits for value in rlimit]
+
+    def apply_to(self, pid):
+        for rlimit, soft, hard in self.get_rlimits():
+            resource.prlimit(pid, rlimit, (soft, hard))
+
+class RunResult():
+    def __init__(self, returncode, timed_out, wall_time, user_time, system_time, max_rss, bytes_written):
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.system_time = system_time
+        # In KB, None if it couldn't be measured
+        self.max_rss = max_rss
+        self.bytes_written = bytes_written
+
+    def cpu_limit_exceeded(self):
+        return self.returncode == -signal.SIGXCPU
+
+    def file_size_limit_exceeded(self):
+        return self.returncode == -signal.SIGXFSZ
+
+    def __str__(self):
+        max_rss = "nao medido" if self.max_rss is None else f"{self.max_rss} KB"
+        return (
+            f"tempo {self.wall_time:.2f}s, CPU {self.user_time:.2f}s usuario + {self.system_time:.2f}s sistema, "
+            f"pico de memoria {max_rss}, {self.bytes_written} bytes escritos"
+        )
+
+def get_file_sizes(folder_path):
+    sizes = {}
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                sizes[entry.name] = entry.stat().st_size
+    return sizes
+
+def kill_process_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def get_memory_wrapper():
+    # Compiled once for each version of the source, next to the .pyc files. None if it can't be compiled
+    global memory_wrapper_path
+    with memory_wrapper_lock:
+        if memory_wrapper_path is None:
+            source_hash = hashlib.sha256(MEMORY_WRAPPER_SOURCE.encode()).hexdigest()[:16]
+            cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+            memory_wrapper_path = os.path.join(cache_path, f"medidor-memoria-{source_hash}")
+            if not os.path.isfile(memory_wrapper_path):
+                # Renamed when done, other corrections may be compiling it at the same time
+                temp_path = f"{memory_wrapper_path}.{os.getpid()}"
+                try:
+                    os.makedirs(cache_path, exist_ok=True)
+                    subprocess.run(
+                        ["cc", "-O2", "-x", "c", "-", "-o", temp_path],
+                        input=MEMORY_WRAPPER_SOURCE.encode(),
+                        capture_output=True,
+                        timeout=30,
+                        check=True
+                    )
+                    os.replace(temp_path, memory_wrapper_path)
+                except (OSError, subprocess.SubprocessError):
+                    memory_wrapper_path = ""
+        return memory_wrapper_path or None
+
+def get_peak_memory(pid):
+    # Only while the process runs, the exited ones have no VmHWM
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def get_children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+            return [int(child) for child in children_file.read().split()]
+    except OSError:
+        return []
+
+def run(command, cwd, timeout, limits=None):
+    sizes_before = get_file_sizes(cwd)
+    memory_wrapper = get_memory_wrapper()
+    read_fd, write_fd = os.pipe()
+    start = time.monotonic()
+
+    # Without limits nothing is set, not even the core dumps
+    limits = limits or RunLimits(core_dumps=True)
+    # In its own session, so the whole process group can be killed. Without stdin, so reading from it fails right away
+    try:
+        process = subprocess.Popen(
+            [memory_wrapper, str(write_fd), *limits.get_wrapper_args(), *command] if memory_wrapper else command,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+            pass_fds=(write_fd,) if memory_wrapper else ()
+        )
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    if not memory_wrapper:
+        # Without the wrapper the limits are only set once the code started, a few microseconds without them
+        try:
+            limits.apply_to(process.pid)
+        except (ProcessLookupError, PermissionError):
+            pass
+    timed_out = False
+    max_rss = None
+    # Readable once the process exits, which still leaves it unreaped
+    pidfd = os.pidfd_open(process.pid)
+    try:
+        readable, _, _ = select.select([pidfd], [], [], timeout)
+        if not readable:
+            timed_out = True
+            # Still running, so its peak can be read before it is killed
+            pids = get_children(process.pid) if memory_wrapper else [process.pid]
+            max_rss = max((rss for rss in map(get_peak_memory, pids) if rss is not None), default=None)
+    finally:
+        os.close(pidfd)
+        # Also kills anything the student code forked. The unreaped leader keeps the group id from being reused
+        kill_process_group(process.pid)
+    # wait4 instead of process.wait, to get the rusage of this run only (the wrapper adds the one of the student code)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.monotonic() - start
+    with os.fdopen(read_fd) as wrapper_output:
+        output = wrapper_output.read().strip()
+    if output.isdigit():
+        max_rss = int(output)
+
+    sizes_after = get_file_sizes(cwd)
+    bytes_written = sum(size for name, size in sizes_after.items() if sizes_before.get(name) != size)
+
+    return RunResult(
+        returncode=process.returncode,
+        timed_out=timed_out,
+        wall_time=wall_time,
+        user_time=rusage.ru_utime,
+        system_time=rusage.ru_stime,
+        max_rss=max_rss,
+        bytes_written=bytes_written
+    )
+
+def expand(folder_path, pattern):
+    # Glob expansion done in python, so no shell is needed and the folder name needs no quoting
+    return sorted(glob.glob(os.path.join(glob.escape(folder_path), pattern)))
+
+def copy_matching(folder_path, pattern, destination_path):
+    paths = expand(folder_path, pattern)
+    for path in paths:
+        shutil.copy(path, destination_path)
+    return paths
+
+def compile_code(compiler, flags, source_paths, binary_path, timeout):
+    # Raises subprocess.CalledProcessError and subprocess.TimeoutExpired, like subprocess.run
+    process = subprocess.Popen(
+        [compiler, *flags, *source_paths, "-o", binary_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    try:
+        _, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # The compiler driver leaves cc1plus, as and ld running if only it is killed
+        kill_process_group(process.pid)
+        process.communicate()
+        raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr)
+    return subprocess.CompletedProcess(process.args, process.returncode, stderr=stderr)
+
+def is_inside(path, folder_paths):
+    return any(path == folder_path or path.startswith(folder_path + os.sep) for folder_path in folder_paths)
+
+def sweep_leftover_processes(folder_paths):
+    # Processes still running from or inside the correction folders, e.g. a student binary that left its process group.
+    # Only the student binaries are killed, anything else (like a shell opened in a student folder) is just reported
+    folder_paths = [os.path.realpath(folder_path) for folder_path in folder_paths if folder_path]
+    leftovers = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or int(pid) in (os.getpid(), os.getppid()):
+            continue
+        try:
+            # Removed folders show up as "<path> (deleted)", which still starts with the folder path
+            exe = os.readlink(f"/proc/{pid}/exe")
+            cwd = os.readlink(f"/proc/{pid}/cwd")
+            with open(f"/proc/{pid}/cmdline", "rb") as cmdline_file:
+                command = cmdline_file.read().replace(b"\0", b" ").decode(errors="replace").strip()
+        except OSError:
+            continue
+        killed = False
+        if is_inside(exe, folder_paths):
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+                killed = True
+            except ProcessLookupError:
+                continue
+        elif not is_inside(cwd, folder_paths):
+            continue
+        leftovers.append((int(pid), command, killed))
+    return leftovers
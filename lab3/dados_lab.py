@@ -25,6 +25,63 @@ class DadosLab:
             help="Ativa detecção de bronco"
         )
 
+        parser.add_argument(
+            "-j", "--jobs",
+            type=int,
+            default=1,
+            help="Numero de alunos corrigidos em paralelo (padrão: 1)"
+        )
+
+        parser.add_argument(
+            "-t", "--testcase-jobs",
+            type=int,
+            default=1,
+            help="Numero de casos teste de um mesmo aluno executados em paralelo (padrão: 1)"
+        )
+
+        parser.add_argument(
+            "--ai-jobs",
+            type=int,
+            default=4,
+            help="Numero de pedidos a IA em andamento ao mesmo tempo na deteccao de bronco (padrão: 4)"
+        )
+
+        parser.add_argument(
+            "--ai-only",
+            action="store_true",
+            help="Apenas processa a fila de pedidos a IA deixada por correcoes anteriores, sem corrigir de novo"
+        )
+
+        parser.add_argument(
+            "--refresh-ai",
+            action="store_true",
+            help="Ignora as respostas da IA guardadas no cache e faz os pedidos de novo"
+        )
+
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="Recompila todos os alunos sem usar o cache de compilacao"
+        )
+
+        parser.add_argument(
+            "--execution-root",
+            help="Pasta em RAM (ex: /dev/shm) para binarios, entradas e saidas durante a execucao"
+        )
+
+        parser.add_argument(
+            "-w", "--watch",
+            action="store_true",
+            help="Fica observando a pasta dos alunos e corrige apenas os envios novos ou modificados"
+        )
+
+        parser.add_argument(
+            "--watch-interval",
+            type=float,
+            default=5,
+            help="Segundos entre as verificacoes da pasta no modo --watch (padrão: 5)"
+        )
+
         parser.add_argument(
             "error_type",
             nargs="?",
@@ -40,8 +97,69 @@ class DadosLab:
 
         self.testcases_path = os.path.join(self.lab_folder_path, "testcases")
         self.student_errors_path = os.path.join(self.lab_folder_path, "erros-alunos")
+        self.results_db_path = os.path.join(self.lab_folder_path, "resultados.sqlite3")
         self.students_path = os.path.join(self.lab_folder_path, args.students_path)
 
         self.error_type_to_correct = args.error_type
-        self.do_bronco_detection = args.bronco
+        # The AI stage only drains the queue, so it always has the bronco detection on
+        self.ai_only = args.ai_only
+        self.do_bronco_detection = args.bronco or args.ai_only
         self.student_to_correct = args.student
+        self.jobs = max(1, args.jobs)
+        self.testcase_jobs = max(1, args.testcase_jobs)
+        self.ai_jobs = max(1, args.ai_jobs)
+        self.refresh_ai = args.refresh_ai
+        self.execution_root = args.execution_root
+        self.watch = args.watch
+        self.watch_interval = args.watch_interval
+
+        # Students compiled in parallel, ahead of the testcase execution
+        self.compile_jobs = os.cpu_count() or 1
+
+        # How many compiled students can be waiting for the testcase execution
+        self.compiled_queue_size = 2 * self.jobs
+
+        self.compiler = "g++"
+        self.compile_flags = []
+        self.compile_timeout = 10
+
+        # Compiled binaries are reused while the source, compiler and flags don't change
+        self.use_compilation_cache = not args.no_cache
+        self.compilation_cache_path = os.path.join(self.lab_folder_path, "cache-compilacao")
+        self.compilation_cache_max_size = 512 * 1024 * 1024
+
+        # AI responses are reused while the model and the prompt (which has the student code) don't change
+        self.ai_cache_path = os.path.join(self.lab_folder_path, "cache-ia")
+        self.ai_cache_max_size = 64 * 1024 * 1024
+        self.ai_cache_ttl = 30 * 24 * 60 * 60
+
+        # Requests and tokens per minute allowed by the quota of each API key (GEMINI_API_KEYS)
+        self.ai_requests_per_minute = 10
+        self.ai_tokens_per_minute = 250000
+        self.ai_rate_limit_path = os.path.join(self.lab_folder_path, "limite-ia.json")
+
+        # Student codes are sent without comments and blank lines, and cut after this many characters
+        self.ai_max_code_size = 40000
+
+        # The AI stage runs after the grading is saved. A request is retried ai_max_retries times, a student
+        # stays in the queue for ai_job_max_attempts stages, and the stage stops after ai_failure_threshold
+        # failed students in a row, until ai_breaker_cooldown seconds have passed
+        self.ai_max_retries = 5
+        self.ai_job_max_attempts = 3
+        self.ai_failure_threshold = 5
+        self.ai_breaker_cooldown = 300
+
+        # Increase this if a testcase takes long to run
+        self.run_timeout = 150
+
+        # Limits applied to each run of the student code, None for no limit
+        self.run_cpu_limit = self.run_timeout + 1
+        self.run_memory_limit = 2 * 1024 * 1024 * 1024
+        # Max size of each file written, so an endless output can't fill the disk
+        self.run_output_limit = 64 * 1024 * 1024
+        # Counts every process of the user running the correction, not only the student ones
+        self.run_process_limit = None
+        self.run_core_dumps = False
+
+        # Outputs bigger than this (in bytes) fail the testcase without being read
+        self.max_output_size = 64 * 1024 * 1024
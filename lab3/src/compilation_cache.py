@@ -0,0 +1,85 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+
+class CompilationCache():
+    def __init__(self, cache_path, max_size):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    # The lock can't be sent to the --jobs workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_key(self, source_paths, compiler, flags):
+        key = hashlib.sha256()
+        key.update(compiler.encode())
+        for flag in flags:
+            key.update(b"\0" + flag.encode())
+        # The paths are part of the key, the warnings (and __FILE__ in the binary) have them. So a student never gets
+        # the warnings with the name of another one that sent the same code
+        for source_path in sorted(source_paths):
+            with open(source_path, "rb") as source_file:
+                key.update(b"\0" + source_path.encode() + b"\0" + hashlib.sha256(source_file.read()).digest())
+        return key.hexdigest()
+
+    def get(self, key, binary_path):
+        # Returns the stored compiler warnings, or None on a miss
+        entry_path = os.path.join(self.cache_path, key)
+        try:
+            shutil.copy2(os.path.join(entry_path, "a.out"), binary_path)
+            with open(os.path.join(entry_path, "warnings.txt"), encoding="utf-8") as warnings_file:
+                warnings = warnings_file.read()
+            # The entry mtime is the last use, for the LRU eviction
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return warnings
+
+    def put(self, key, binary_path, warnings):
+        entry_path = os.path.join(self.cache_path, key)
+        temp_entry_path = tempfile.mkdtemp(dir=self.cache_path, prefix=".tmp-")
+        shutil.copy2(binary_path, os.path.join(temp_entry_path, "a.out"))
+        with open(os.path.join(temp_entry_path, "warnings.txt"), "w", encoding="utf-8") as warnings_file:
+            warnings_file.write(warnings)
+        try:
+            os.rename(temp_entry_path, entry_path)
+        except OSError:
+            # Another thread already stored the same binary
+            shutil.rmtree(temp_entry_path, ignore_errors=True)
+        with self.lock:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        with os.scandir(self.cache_path) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.startswith(".tmp-") or not dir_entry.is_dir():
+                    continue
+                entry_size = sum(f.stat().st_size for f in os.scandir(dir_entry.path))
+                entries.append((dir_entry.stat().st_mtime, entry_size, dir_entry.path))
+                total_size += entry_size
+
+        # Least recently used entries go first
+        for _, entry_size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= entry_size
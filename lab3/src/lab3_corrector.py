@@ -1,11 +1,28 @@
 import os
+import io
+import errno
+import mmap
 import subprocess
 import glob
 import shutil
 import traceback
 import json
 import re
-from .bronco_finder_agent import CorrectorAgent
+import queue
+import threading
+import multiprocessing
+import tempfile
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .bronco_finder_agent import CorrectorAgent, AgentRequestPool, MOCK_TEXT
+from .llm_backend import GeminiBackend, create_backend
+from .compilation_cache import CompilationCache
+from .response_cache import ResponseCache
+from .rate_limiter import KeyRateLimiter, CircuitBreaker
+from .prompt_compaction import compact_code, compact_text, dedupe
+from .results_db import ResultsDatabase
+from . import runner
 
 class CorrectionFailed(Exception):
     def __init__(self, student, error_type, message):
@@ -29,6 +46,16 @@ class FailedTestcaseError(CorrectionFailed):
     def __init__(self, student, message):
         super().__init__(student, "ERRO-CASOS-TESTE", message)
 
+# The corrector of a correction worker process, sent once when the worker starts instead of with every student
+worker_corrector = None
+
+def init_correction_worker(corrector):
+    global worker_corrector
+    worker_corrector = corrector
+
+def correct_student_in_worker(student):
+    return worker_corrector.correct_student(student)
+
 class Student():
     def __init__(self, student_path):
         self.path = student_path
@@ -37,6 +64,15 @@ class Student():
         self.logs = []
         self.num_total_testcases = 0
         self.num_passed_testcases = 0
+        self.compiled = False
+        # Where the binary, inputs and raw outputs live while correcting
+        self.execution_path = student_path
+        # Testcase name -> runner.RunResult, with the CPU time, peak memory and bytes written of the run
+        self.run_usages = {}
+        # Testcase name -> (passed, messages)
+        self.testcase_results = {}
+        # Only the codes that passed the file name checks are sent to the AI
+        self.code_checked = False
 
 class Lab3Corrector():
     def __init__(self, dados_lab):
@@ -44,15 +80,61 @@ class Lab3Corrector():
         self.testcases_path = dados_lab.testcases_path
         self.student_errors_path = dados_lab.student_errors_path
         self.numero_lab = dados_lab.numero_lab
+        # Sorted, so the testcases always run and get logged in the same order
+        self.testcases = sorted(os.listdir(self.testcases_path))
+        # Parsed once, instead of for every student
+        self.answers = self.load_answers()
         self.do_bronco_detection = dados_lab.do_bronco_detection
         self.error_type_to_correct = dados_lab.error_type_to_correct
         self.student_to_correct = dados_lab.student_to_correct
+        self.jobs = dados_lab.jobs
+        self.max_output_size = dados_lab.max_output_size
+        self.compile_jobs = dados_lab.compile_jobs
+        self.compiled_queue_size = dados_lab.compiled_queue_size
+        self.testcase_jobs = dados_lab.testcase_jobs
+        self.run_timeout = dados_lab.run_timeout
+        self.compile_timeout = dados_lab.compile_timeout
+        self.run_limits = runner.RunLimits(
+            cpu_seconds=dados_lab.run_cpu_limit,
+            address_space=dados_lab.run_memory_limit,
+            file_size=dados_lab.run_output_limit,
+            processes=dados_lab.run_process_limit,
+            core_dumps=dados_lab.run_core_dumps
+        )
+        self.compiler = dados_lab.compiler
+        self.compile_flags = dados_lab.compile_flags
+        self.results_db = ResultsDatabase(dados_lab.results_db_path)
+        # The AI requests run after the grading is saved, in the AI stage (also alone with --ai-only)
+        self.bronco_requests = None
+        self.ai_cache = None
+        self.ai_rate_limiter = None
+        self.ai_backend = None
+        self.ai_max_code_size = dados_lab.ai_max_code_size
+        self.ai_jobs = dados_lab.ai_jobs
+        self.ai_job_max_attempts = dados_lab.ai_job_max_attempts
+        self.ai_circuit_breaker = CircuitBreaker(dados_lab.ai_failure_threshold, dados_lab.ai_breaker_cooldown)
+        if self.do_bronco_detection:
+            self.ai_backend = create_backend(MOCK_TEXT)
+            # The mock answers (AI_BACKEND=mock) are neither cached nor limited
+            if isinstance(self.ai_backend, GeminiBackend):
+                # Unchanged submissions get the stored response instead of a new request
+                self.ai_cache = ResponseCache(dados_lab.ai_cache_path, dados_lab.ai_cache_max_size, dados_lab.ai_cache_ttl, refresh=dados_lab.refresh_ai)
+                # One limit for each API key, shared through a file with the other corrections using the same key
+                self.ai_rate_limiter = KeyRateLimiter(dados_lab.ai_rate_limit_path, self.ai_backend.api_keys, dados_lab.ai_requests_per_minute, dados_lab.ai_tokens_per_minute)
+            self.bronco_requests = AgentRequestPool(CorrectorAgent(cache=self.ai_cache, rate_limiter=self.ai_rate_limiter, backend=self.ai_backend), dados_lab.ai_jobs, dados_lab.ai_max_retries)
+        self.watch_interval = dados_lab.watch_interval
+        self.compilation_cache = None
+        if dados_lab.use_compilation_cache:
+            self.compilation_cache = CompilationCache(dados_lab.compilation_cache_path, dados_lab.compilation_cache_max_size)
+        self.execution_root = None
+        # Binaries, inputs and raw outputs go to a RAM backed folder (e.g. /dev/shm) instead of the student folder
+        if dados_lab.execution_root:
+            os.makedirs(dados_lab.execution_root, exist_ok=True)
+            self.execution_root = tempfile.mkdtemp(prefix=f"correcao-lab{self.numero_lab}-", dir=dados_lab.execution_root)
 
         if self.student_to_correct:
             self.error_type_to_correct = 'ALL'
 
-        self.student = None
-
         self.error_files = [
             "ARQUIVO-NOME-ERRADO.txt",
             "ERRO-COMPILACAO.txt",
@@ -64,8 +146,6 @@ class Lab3Corrector():
         self.create_student_folders()
         self.students = self.get_students_list()
 
-        self.remove_error_type_txts()
-
     def get_students_list(self):
         if self.student_to_correct:
             student_path = os.path.join(self.students_path, self.student_to_correct)
@@ -77,33 +157,32 @@ class Lab3Corrector():
             student_path = os.path.join(self.students_path, folder)
             students.append(Student(student_path))
 
-        for file in self.error_files:
-            error_file_path = os.path.join(self.student_errors_path, file)
-            os.makedirs(self.student_errors_path, exist_ok=True)
-            if not os.path.isfile(error_file_path):
-                continue
-            with open(error_file_path, "r") as f:
-                for line in f:
-                    student_name = line.strip()
-                    if student_name:
-                        for student in students:
-                            if student.name == student_name:
-                                student.error_type = file[:-4]
+        error_types = self.results_db.get_error_types()
+        for student in students:
+            student.error_type = error_types.get(student.name)
         return sorted(students, key=lambda x: x.name)                          
             
-    def clear_logs_file(self):
-        logs_correcao_path = self.student.path + "/logs_correcao_auto.txt"
+    def load_answers(self):
+        answers = {}
+        for testcase in self.testcases:
+            answers_path = os.path.join(self.testcases_path, testcase, f'saida{self.numero_lab}.json')
+            with open(answers_path, "r", encoding="utf-8") as answers_file:
+                answers[testcase] = json.load(answers_file)
+        return answers
+
+    def clear_logs_file(self, student):
+        logs_correcao_path = student.path + "/logs_correcao_auto.txt"
         open(logs_correcao_path, "w").close()
 
-    def log_errors(self, encoding):
-        logs_correcao_path = self.student.path + "/logs_correcao_auto.txt"
+    def log_errors(self, student, encoding):
+        logs_correcao_path = student.path + "/logs_correcao_auto.txt"
         with open(logs_correcao_path, "a", encoding=encoding) as logs:
-            print(f"{self.student.error_type}\n", file=logs)                
-            for error_log in self.student.logs:
+            print(f"{student.error_type}\n", file=logs)                
+            for error_log in student.logs:
                 print(error_log, file=logs)
 
-    def add_log(self, message, encoding):
-        logs_correcao_path = self.student.path + "/logs_correcao_auto.txt"
+    def add_log(self, student, message, encoding):
+        logs_correcao_path = student.path + "/logs_correcao_auto.txt"
         with open(logs_correcao_path, "a", encoding=encoding) as logs:
             print(message, file=logs)                
 
@@ -128,126 +207,170 @@ class Lab3Corrector():
             os.makedirs(new_folder_path, exist_ok=True)
             shutil.move(file_path, os.path.join(new_folder_path, filename))  
 
-    def remove_outputs_folder(self):
-        outputs_path = os.path.join(self.student.path, "outputs")
+    def remove_outputs_folder(self, student):
+        outputs_path = os.path.join(student.path, "outputs")
         if os.path.exists(outputs_path) and os.path.isdir(outputs_path):
             shutil.rmtree(outputs_path)
 
-    def remove_unwanted_files(self):
-        for f in os.listdir(self.student.path):
-            full_path = os.path.join(self.student.path, f)
+    def remove_unwanted_files(self, student):
+        for f in os.listdir(student.path):
+            full_path = os.path.join(student.path, f)
             if f == "a.out":
                 os.remove(full_path)
             elif f.endswith(".txt") and not f.startswith("logs_correcao"):
                 os.remove(full_path)
 
-    def remove_error_type_txts(self):
-        for file in self.error_files:
-            error_file_path = os.path.join(self.student_errors_path, file)
-            if os.path.isfile(error_file_path):
-                os.remove(error_file_path)
-
-    def create_error_type_txts(self):
-        for student in self.students:
-            error_file = f"{student.error_type}.txt"
-            error_file_path = os.path.join(self.student_errors_path, error_file)
-            with open(error_file_path, "a") as file:
-                file.write(student.name + "\n")
-
-    def get_and_handle_output(self, testcase):
-        output_path = glob.glob(f'{self.student.path}/Lab*.txt')
+    def get_source_hash(self, student):
+        source_hash = hashlib.sha256()
+        for source_path in runner.expand(student.path, 'Lab*.cpp'):
+            with open(source_path, "rb") as source_file:
+                source_hash.update(hashlib.sha256(source_file.read()).digest())
+        return source_hash.hexdigest()
+
+    def save_results(self, students):
+        source_hashes = {student.name: self.get_source_hash(student) for student in students}
+        self.results_db.save_students(students, source_hashes)
+        # The text files are only an export now, the database is what the next run reads
+        self.results_db.export_error_type_txts(self.student_errors_path, self.error_files)
+
+    def archive_output(self, output_path, final_output_path):
+        # A rename on the same filesystem, a copy only across devices (e.g. with the execution folder in RAM)
+        try:
+            os.replace(output_path, final_output_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy(output_path, final_output_path)
+            os.remove(output_path)
+
+    def split_output_lines(self, data, encoding):
+        lines = []
+        for raw_line in iter(data.readline, b""):
+            line = str(raw_line, encoding)
+            if "\r" in line:
+                # newline=None splits the lines the same way a file opened in text mode does
+                lines.extend(io.StringIO(line, newline=None).readlines())
+            else:
+                lines.append(line)
+        return lines
+
+    def read_output_lines(self, output_path):
+        # Split on a memory-mapped view of the archived output and decoded line by line, so only the list of lines is built
+        with open(output_path, 'rb') as output_file:
+            if os.fstat(output_file.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(output_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                try:
+                    return self.split_output_lines(data, 'utf-8')
+                except UnicodeDecodeError:
+                    # The whole output is read again as latin1, not only the lines that aren't utf-8
+                    data.seek(0)
+                    return self.split_output_lines(data, 'latin1')
+
+    def get_and_handle_output(self, student, testcase, scratch_path):
+        output_path = glob.glob(f'{scratch_path}/Lab*.txt')
         if not output_path:
-            raise FailedTestcaseError(self.student, "Nao criou o arquivo txt de saida\n")
-        output_folder = os.path.join(self.student.path, 'outputs')
+            raise FailedTestcaseError(student, "Nao criou o arquivo txt de saida\n")
+        output_folder = os.path.join(student.path, 'outputs')
         os.makedirs(output_folder, exist_ok=True)
         final_output_path = os.path.join(output_folder, f"{testcase}.txt")
-        shutil.copy(output_path[0], final_output_path)
-        os.remove(output_path[0])
-        try:
-            with open(final_output_path, encoding='utf-8') as output_file:
-                return output_file.readlines()
-        except UnicodeDecodeError:           
-            with open(final_output_path, encoding='latin1') as output_file:
-                return output_file.readlines()
+        self.archive_output(output_path[0], final_output_path)
+        if os.path.getsize(final_output_path) > self.max_output_size:
+            raise FailedTestcaseError(student, f"Output maior que o limite de {self.max_output_size} bytes no caso teste {testcase}\n")
+        return self.read_output_lines(final_output_path)
         
-    def get_student_code(self):
-        cpp_path = glob.glob(f'{self.student.path}/Lab*.cpp')
+    def get_student_code(self, student):
+        cpp_path = glob.glob(f'{student.path}/Lab*.cpp')
         if not cpp_path:
-            raise WrongFilePathError(self.student, "Nao enviou o arquivo .cpp\n")
+            raise WrongFilePathError(student, "Nao enviou o arquivo .cpp\n")
         with open(cpp_path[0], encoding='latin-1') as cpp_file:
             return cpp_file.read()
 
-    def compile_student_code(self):
-        if os.path.isdir(self.student.path):
-            cpp_path = os.path.join(f'{self.student.path}/Lab*.cpp')
+    def compile_student_code(self, student):
+        if os.path.isdir(student.path):
+            cpp_paths = runner.expand(student.path, 'Lab*.cpp')
+            binary_path = os.path.join(student.execution_path, "a.out")
+            if self.compilation_cache:
+                cache_key = self.compilation_cache.get_key(cpp_paths, self.compiler, self.compile_flags)
+                warnings = self.compilation_cache.get(cache_key, binary_path)
+                if warnings is not None:
+                    if warnings:
+                        self.add_log(student, f"WARNINGS NA COMPILACAO:\n{warnings}", encoding="utf-8")
+                    return
             try:
-                result = subprocess.run(
-                    f'g++ {cpp_path} -o {self.student.path}/a.out',
-                    shell=True, 
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.PIPE,
-                    timeout=10
-                )
+                result = runner.compile_code(self.compiler, self.compile_flags, cpp_paths, binary_path, timeout=self.compile_timeout)
+                warnings = result.stderr.decode('utf-8', errors='replace')
                 if result.returncode == 0 and result.stderr:
-                    self.add_log(f"WARNINGS NA COMPILACAO:\n{result.stderr.decode('utf-8', errors='replace')}", encoding="utf-8")
+                    self.add_log(student, f"WARNINGS NA COMPILACAO:\n{warnings}", encoding="utf-8")
             except subprocess.CalledProcessError as e:
-                raise CompilationError(self.student, f"Codigo de saida: {e.returncode}\n")
+                raise CompilationError(student, f"Codigo de saida: {e.returncode}\n")
             except subprocess.TimeoutExpired:
-                raise CompilationError(self.student, f"Tempo limite de compilacao excedido.")
+                raise CompilationError(student, f"Tempo limite de compilacao excedido.")
             except Exception as e:
-                raise CompilationError(self.student, f"Ocorreu um erro inesperado na compilacao: {e}\n")
+                raise CompilationError(student, f"Ocorreu um erro inesperado na compilacao: {e}\n")
+            if self.compilation_cache:
+                self.compilation_cache.put(cache_key, binary_path, warnings)
+
+    def create_scratch_folder(self, student, testcase):
+        scratch_path = tempfile.mkdtemp(prefix=f"scratch-{testcase}-", dir=student.execution_path)
+        binary_path = os.path.join(student.execution_path, "a.out")
+        try:
+            os.link(binary_path, os.path.join(scratch_path, "a.out"))
+        except OSError:
+            shutil.copy2(binary_path, scratch_path)
+        return scratch_path
 
-    def run_student_code(self, testcase):
+    def run_student_code(self, student, testcase, scratch_path):
         testcase_path = os.path.join(self.testcases_path, testcase)
         input_file = os.path.join(testcase_path, f"entrada{self.numero_lab}.txt")
-        shutil.copy(input_file, self.student.path)
+        shutil.copy(input_file, scratch_path)
         input_file = os.path.join(testcase_path, f"Entrada{self.numero_lab}.txt")
-        shutil.copy(input_file, self.student.path)
+        shutil.copy(input_file, scratch_path)
 
         try:
-            subprocess.run(
-                './a.out', 
-                cwd=self.student.path, 
-                shell=True, 
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                timeout=150
-            )
-        except subprocess.CalledProcessError as e:
-            raise FailedTestcaseError(self.student, f"Erro na execucao do caso teste {testcase}.\nCodigo de saida: {e.returncode}\n")
-        except subprocess.TimeoutExpired:
-            raise FailedTestcaseError(self.student, f"Tempo limite de execucao do caso teste {testcase} excedido")
+            result = runner.run(['./a.out'], cwd=scratch_path, timeout=self.run_timeout, limits=self.run_limits)
         except Exception as e:
-            raise FailedTestcaseError(self.student, f"Ocorreu um erro inesperado na execucao do caso teste {testcase}: {e}\n")
-
-    def check_fopen_path(self, student_code):
+            raise FailedTestcaseError(student, f"Ocorreu um erro inesperado na execucao do caso teste {testcase}: {e}\n")
+        student.run_usages[testcase] = result
+
+        if result.timed_out:
+            raise FailedTestcaseError(student, f"Tempo limite de execucao do caso teste {testcase} excedido")
+        if result.cpu_limit_exceeded():
+            raise FailedTestcaseError(student, f"Limite de tempo de CPU do caso teste {testcase} excedido")
+        if result.file_size_limit_exceeded():
+            raise FailedTestcaseError(student, f"Limite de tamanho dos arquivos de saida do caso teste {testcase} excedido")
+        if result.returncode != 0:
+            raise FailedTestcaseError(student, f"Erro na execucao do caso teste {testcase}.\nCodigo de saida: {result.returncode}\n")
+
+    def check_fopen_path(self, student, student_code):
         pattern_entrada = fr'fopen\s*\(\s*"[Ee]ntrada{self.numero_lab}\.txt"\s*,\s*".*?"\s*\)'
         pattern_saida = fr'fopen\s*\(\s*"Lab{self.numero_lab}_[a-zA-Z0-9_]+\.txt"\s*,\s*".*?"\s*\)'
         nome_entrada_correto = re.search(pattern_entrada, student_code) is not None
         nome_saida_correto = re.search(pattern_saida, student_code) is not None
         if not nome_entrada_correto or not nome_saida_correto:
-            raise WrongFilePathError(self.student, "Erro no nome dos arquivos de entrada ou saída\n")
+            raise WrongFilePathError(student, "Erro no nome dos arquivos de entrada ou saída\n")
 
-    def correct_code(self):
-        code = self.get_student_code()
-        self.check_fopen_path(code)
-        if self.do_bronco_detection:
-            self.detect_bronco(code)
+    def correct_code(self, student):
+        code = self.get_student_code(student)
+        self.check_fopen_path(student, code)
+        student.code_checked = True
         
-    def correct_output(self, testcase):
-        self.run_student_code(testcase)
-        output = self.get_and_handle_output(testcase)
-        self.test_formatacao(testcase, output)
-        self.compare_with_testcase(testcase, output)
-
-    def test_formatacao(self, testcase, output):
+    def correct_output(self, student, testcase):
+        scratch_path = self.create_scratch_folder(student, testcase)
+        try:
+            self.run_student_code(student, testcase, scratch_path)
+            output = self.get_and_handle_output(student, testcase, scratch_path)
+        finally:
+            shutil.rmtree(scratch_path, ignore_errors=True)
+        self.test_formatacao(student, testcase, output)
+        self.compare_with_testcase(student, testcase, output)
+
+    def test_formatacao(self, student, testcase, output):
         linhas = [linha.rstrip('\n') for linha in output] 
 
         if len(linhas) < 4:
             raise OutputFormattingError(
-                self.student,
+                student,
                 f"Output vazio no caso teste {testcase}"
             )
         
@@ -260,7 +383,7 @@ class Lab3Corrector():
             pos += 1
             if pos >= len(linhas):
                 raise OutputFormattingError(
-                    self.student,
+                    student,
                     f"Nao printou total de multiplicacoes no caso teste {testcase}"
                 )
         pos += 1
@@ -269,7 +392,7 @@ class Lab3Corrector():
             pos += 1
             if pos >= len(linhas):
                 raise OutputFormattingError(
-                    self.student,
+                    student,
                     f"Nao printou numero de chamadas recursivas no caso teste {testcase}"
                 )
         pos += 1
@@ -278,13 +401,14 @@ class Lab3Corrector():
             pos += 1
             if pos >= len(linhas):
                 raise OutputFormattingError(
-                    self.student,
+                    student,
                     f"Nao printou a ordem de multiplicacao no caso teste {testcase}"
                 )
         pos += 1
 
-    def compare_with_testcase(self, testcase, output):
+    def compare_with_testcase(self, student, testcase, output):
         linhas = [linha.rstrip('\n') for linha in output] 
+        answers = self.answers[testcase]
 
         order = []
         num_operations = None
@@ -318,19 +442,15 @@ class Lab3Corrector():
             elif 'X' in linha:
                 left, _ = linha.split('X')
             else:
-                raise FailedTestcaseError(self.student, f"Output nao faz sentido no caso teste {testcase}")
+                raise FailedTestcaseError(student, f"Output nao faz sentido no caso teste {testcase}")
             values_left = re.findall(r'\d+', left)
             if len(values_left) == 1:
                 order.append(int(values_left[0]))
             elif len(values_left) == 2:
                 order.append(int(values_left[1]))
             else:
-                raise FailedTestcaseError(self.student, f"Output nao faz sentido no caso teste {testcase}")
+                raise FailedTestcaseError(student, f"Output nao faz sentido no caso teste {testcase}")
             
-            answers_path = os.path.join(self.testcases_path, testcase, f'saida{self.numero_lab}.json')
-            with open(answers_path, "r", encoding="utf-8") as answers_file:
-                answers = json.load(answers_file)
-
             error_message = ''
             if num_operations != answers["num_operations"]:
                 error_message += f"Falhou no caso teste {testcase}: NUMERO de operacoes errado\n"
@@ -351,18 +471,16 @@ class Lab3Corrector():
                                 break
                 except Exception as e:
                     error_message += f"Falhou no caso teste {testcase}: ORDEM das operacoes não faz sentido"
-                    raise FailedTestcaseError(self.student, error_message)
+                    raise FailedTestcaseError(student, error_message)
 
                 if num_operations != answers["num_operations"]:
                     error_message += f"Falhou no caso teste {testcase}: ORDEM NAO OTIMA"
                 else:
                     error_message += f"Falhou no caso teste {testcase}: ORDEM CORRETA mas FORA DO PADRAO"
-                raise FailedTestcaseError(self.student, error_message)
+                raise FailedTestcaseError(student, error_message)
 
 
-    def detect_bronco(self, code):
-        corrector_agent = CorrectorAgent()
-        
+    def detect_bronco(self, student, code):
         prompt = '''
         **Sua função principal**: Você irá identificar no código do aluno processos que tornem o código repetitivo ou que realizam operações
         desnecessárias. Por exemplo, dar malloc em cada posição de um vetor em vez de dar um único malloc no vetor inteiro, ou usar uma lógica
@@ -375,7 +493,7 @@ class Lab3Corrector():
         Não seja pedântico.
         '''
 
-        final_instructions = f'''
+        final_instructions = '''
         **Formato da resposta**:  
         - Escreva em bullet points (um item por linha).
         - Se não houver nada a apontar em uma seção, escreva: “Nenhum problema identificado”.  
@@ -386,38 +504,237 @@ class Lab3Corrector():
         2) Problema 2
 
         Segue o código do aluno:
-
-        {code}
         '''
 
-        prompt = f"{prompt}\n\n{final_instructions}"
+        prompt = f"{compact_text(prompt)}\n\n{compact_text(final_instructions)}\n\n{compact_code(code, self.ai_max_code_size)}"
 
-        response = corrector_agent.respond(prompt)
-        
-        logs_bronco_path = self.student.path + "/logs_correcao_bronco.txt"
+        self.bronco_requests.submit(student.name, prompt)
+
+    def save_bronco_detection(self, student):
+        response = self.bronco_requests.result(student.name)
+        if response is None:
+            return
+        # In the student's log, the AI stage threads would interleave it on the terminal. The total is printed at the end
+        usage = self.bronco_requests.usages.pop(student.name)
+        logs_bronco_path = student.path + "/logs_correcao_bronco.txt"
         with open(logs_bronco_path, "w") as logs:
             for line in response:
-                print(line, file=logs)                
+                print(line, file=logs)
+            print(f"\nUso da IA: {usage}", file=logs)
 
-    def make_student_correction(self):
+    def queue_ai_jobs(self, students):
+        if not self.do_bronco_detection:
+            return
+        self.results_db.queue_ai_jobs([student.name for student in students if student.code_checked])
+        # A job left by an earlier correction is dropped once the code doesn't pass the checks anymore
+        for student in students:
+            if not student.code_checked:
+                self.results_db.remove_ai_job(student.name)
+
+    def run_ai_stage(self):
+        # Drains the AI queue of the results database after the grading, each bronco log is written as its answer arrives.
+        # The failed students stay in the queue for the next stage (--ai-only or the next --watch round)
+        jobs = [
+            Student(os.path.join(self.students_path, name))
+            for name, attempts in self.results_db.get_ai_jobs()
+            if attempts < self.ai_job_max_attempts and (not self.student_to_correct or name == self.student_to_correct)
+        ]
+        if not jobs:
+            return
+        print(f"AI stage: {len(jobs)} students in the queue")
+        running = {}
+        while jobs or running:
+            while jobs and len(running) < self.ai_jobs and self.ai_circuit_breaker.allow_request():
+                student = jobs.pop(0)
+                try:
+                    self.detect_bronco(student, self.get_student_code(student))
+                except WrongFilePathError:
+                    # The code was removed after the grading, there is nothing to ask
+                    self.results_db.remove_ai_job(student.name)
+                    continue
+                running[student.name] = student
+                if not self.bronco_requests.is_submitted(student.name):
+                    self.finish_ai_job(running.pop(student.name))
+            if not running:
+                break
+            self.finish_ai_job(running.pop(self.bronco_requests.wait_next()))
+        if self.ai_circuit_breaker.is_open():
+            print(f"AI stage stopped after {self.ai_circuit_breaker.failures} failed students in a row")
+        left_jobs = len([name for name, attempts in self.results_db.get_ai_jobs() if attempts < self.ai_job_max_attempts])
+        if left_jobs:
+            print(f"{left_jobs} students left in the AI queue, run again with --ai-only to resume")
+        if self.ai_cache:
+            print(f"AI cache: {self.ai_cache.hits} hits, {self.ai_cache.misses} misses")
+        print(f"AI usage: {self.bronco_requests.usage}")
+
+    def finish_ai_job(self, student):
         try:
-            self.correct_code()
-            self.compile_student_code()
-        except (CompilationError, WrongFilePathError):
+            self.save_bronco_detection(student)
+        except Exception as e:
+            self.ai_circuit_breaker.record_failure()
+            self.results_db.fail_ai_job(student.name, str(e))
+            print(f"AI request of {student.name} failed: {e}")
             return
-        self.add_log(f"\n{"-"*25}\nRESULTADOS CASOS TESTE:\n{"-"*25}\n", encoding="utf-8")
-        for testcase in os.listdir(self.testcases_path):
+        self.ai_circuit_breaker.record_success()
+        self.results_db.remove_ai_job(student.name)
+
+    def make_ai_correction(self):
+        try:
+            self.run_ai_stage()
+            print("AI correction ended successfully")
+        except Exception as e:
+            print(f"AI correction failed due to error: {e}")
+            traceback.print_exc()
+        finally:
+            self.clean_up()
+
+    def create_execution_folder(self, student):
+        if not self.execution_root:
+            return student.path
+        execution_path = os.path.join(self.execution_root, student.name)
+        os.makedirs(execution_path, exist_ok=True)
+        return execution_path
+
+    def remove_execution_folder(self, student):
+        if student.execution_path != student.path:
+            shutil.rmtree(student.execution_path, ignore_errors=True)
+
+    def compile_student(self, student):
+        self.clear_logs_file(student)
+        self.remove_outputs_folder(student)
+        student.execution_path = self.create_execution_folder(student)
+        try:
+            self.correct_code(student)
+            self.compile_student_code(student)
+            student.compiled = True
+        except (CompilationError, WrongFilePathError):
+            pass
+        return student
+
+    def put_compiled_student(self, compiled_students, result, stop):
+        # With a timeout, so a thread waiting on the full queue still stops once nothing takes from it anymore
+        while not stop.is_set():
             try:
-                self.correct_output(testcase)
-                self.student.num_passed_testcases += 1
-            except (FailedTestcaseError, FailedTestcaseError, OutputFormattingError):
-                continue
-        if not self.student.logs:
-            self.student.error_type = "NO-ERRORS"
+                compiled_students.put(result, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def compile_students(self, students_to_compile, compiled_students, stop):
+        while not stop.is_set():
+            try:
+                student = students_to_compile.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = (self.compile_student(student), None)
+            except Exception as e:
+                result = (student, e)
+            self.put_compiled_student(compiled_students, result, stop)
+
+    def start_compile_stage(self, students_to_correct):
+        students_to_compile = queue.Queue()
+        for student in students_to_correct:
+            students_to_compile.put(student)
+
+        # Bounded, so the compile stage only gets a few students ahead of the testcase execution
+        compiled_students = queue.Queue(maxsize=self.compiled_queue_size)
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self.compile_students, args=(students_to_compile, compiled_students, stop), daemon=True)
+            for _ in range(min(self.compile_jobs, len(students_to_correct)))
+        ]
+        for thread in threads:
+            thread.start()
+        return compiled_students, stop, threads
+
+    def stop_compile_stage(self, stop, threads):
+        # Also when the correction fails midway, the threads finish the student they are compiling and exit
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    def get_compiled_student(self, compiled_students):
+        student, error = compiled_students.get()
+        if error is not None:
+            raise error
+        return student
+
+    def correct_testcase(self, student, testcase):
+        # Each testcase gets its own Student, so the results can be merged back in the testcase order
+        testcase_student = Student(student.path)
+        testcase_student.execution_path = student.execution_path
+        try:
+            self.correct_output(testcase_student, testcase)
+            testcase_student.num_passed_testcases += 1
+        except (FailedTestcaseError, OutputFormattingError):
+            pass
+        testcase_student.testcase_results[testcase] = (testcase_student.num_passed_testcases == 1, list(testcase_student.logs))
+        return testcase_student
+
+    def make_student_correction(self, student):
+        if not student.compiled:
+            return
+        self.add_log(student, f"\n{"-"*25}\nRESULTADOS CASOS TESTE:\n{"-"*25}\n", encoding="utf-8")
+        testcases = self.testcases
+        with ThreadPoolExecutor(max_workers=self.testcase_jobs) as executor:
+            testcase_students = list(executor.map(self.correct_testcase, [student] * len(testcases), testcases))
+        for testcase_student in testcase_students:
+            student.logs.extend(testcase_student.logs)
+            student.error_type = testcase_student.error_type or student.error_type
+            student.num_passed_testcases += testcase_student.num_passed_testcases
+            student.run_usages.update(testcase_student.run_usages)
+            student.testcase_results.update(testcase_student.testcase_results)
+        for testcase in testcases:
+            if testcase in student.run_usages:
+                self.add_log(student, f"Caso teste {testcase}: {student.run_usages[testcase]}", encoding="utf-8")
+        if not student.logs:
+            student.error_type = "NO-ERRORS"
         
 
+    def correct_student(self, student):
+        self.make_student_correction(student)
+        self.remove_execution_folder(student)
+        self.remove_unwanted_files(student)
+        self.add_log(student, f"\n{"-"*25}\nLOGS ERROS:\n{"-"*25}\n", encoding="utf-8")
+        self.log_errors(student, encoding="utf-8")
+        return student
+
+    def correct_students(self, students_to_correct):
+        compiled_students, stop, threads = self.start_compile_stage(students_to_correct)
+        try:
+            if self.jobs == 1:
+                for progress in range(1, len(students_to_correct) + 1):
+                    student = self.get_compiled_student(compiled_students)
+                    print(f"Correcting... ({progress}/{len(students_to_correct)}). Current student: {student.name }")
+                    self.correct_student(student)
+                return
+
+            # Each worker gets a copy of the student, so the corrected ones are gathered back in the original order
+            corrected_students = {}
+            # forkserver, since forking while the compile stage threads hold locks can deadlock the workers
+            with ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context("forkserver"), initializer=init_correction_worker, initargs=(self,)) as executor:
+                running = set()
+                for progress in range(1, len(students_to_correct) + 1):
+                    # Only take a compiled student when a worker is free, so the bounded queue applies backpressure
+                    if len(running) >= self.jobs:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            corrected_students[future.result().name] = future.result()
+                    student = self.get_compiled_student(compiled_students)
+                    print(f"Correcting... ({progress}/{len(students_to_correct)}). Current student: {student.name }")
+                    running.add(executor.submit(correct_student_in_worker, student))
+                for future in running:
+                    corrected_students[future.result().name] = future.result()
+            self.students = [corrected_students.get(student.name, student) for student in self.students]
+        finally:
+            self.stop_compile_stage(stop, threads)
+
+    def report_leftover_processes(self):
+        for pid, command, killed in runner.sweep_leftover_processes([self.students_path, self.execution_root]):
+            print(f"Leftover process {pid} ({command}) {'killed' if killed else 'still running'}")
+
     def make_correction(self):
-        progress = 1
         try:
             for student in self.students:
                 if student.error_type is None:  # If any student error is missing, correct all
@@ -426,22 +743,82 @@ class Lab3Corrector():
             if self.error_type_to_correct == 'ALL':
                 students_to_correct = self.students
             else:
-                students_to_correct = [student for student in self.students if student.error_type == self.error_type_to_correct]
-            for student in students_to_correct:
-                self.student = student
-                print(f"Correcting... ({progress}/{len(students_to_correct)}). Current student: {student.name }")
-                progress += 1
-                self.clear_logs_file()
-                self.remove_outputs_folder()
-                self.make_student_correction()
-                self.remove_unwanted_files()
-                self.add_log(f"\n{"-"*25}\nLOGS ERROS:\n{"-"*25}\n", encoding="utf-8")
-                self.log_errors(encoding="utf-8")
-            self.create_error_type_txts()
+                names_to_correct = self.results_db.get_students_with_error_type(self.error_type_to_correct)
+                students_to_correct = [student for student in self.students if student.name in names_to_correct]
+            self.correct_students(students_to_correct)
+            corrected_names = {student.name for student in students_to_correct}
+            self.save_results([student for student in self.students if student.name in corrected_names])
+            if self.compilation_cache:
+                print(f"Compilation cache: {self.compilation_cache.hits} hits, {self.compilation_cache.misses} misses")
+            # The grading is already saved, an AI outage only leaves the students in the AI queue
+            self.queue_ai_jobs(students_to_correct)
+            if self.do_bronco_detection:
+                self.run_ai_stage()
             print("Correction ended successfully")
         except Exception as e:
             print(f"Correction failed due to error: {e}")
             traceback.print_exc()
+        finally:
+            self.clean_up()
+
+    def clean_up(self):
+        self.report_leftover_processes()
+        if self.execution_root:
+            shutil.rmtree(self.execution_root, ignore_errors=True)
+
+    def get_source_signature(self, student):
+        # Cheap to check every round, the source hash is only computed once the signature changes
+        signature = []
+        for source_path in runner.expand(student.path, 'Lab*.cpp'):
+            source_stat = os.stat(source_path)
+            signature.append((os.path.basename(source_path), source_stat.st_mtime_ns, source_stat.st_size))
+        return tuple(signature)
+
+    def correct_new_submissions(self, signatures, pending):
+        self.create_student_folders()
+        students = self.get_students_list()
+        source_hashes = self.results_db.get_source_hashes()
+        students_to_correct = []
+        for student in students:
+            signature = self.get_source_signature(student)
+            if signatures.get(student.name) != signature:
+                # New or still being written, checked on the next round if it stops changing
+                signatures[student.name] = signature
+                pending.add(student.name)
+                continue
+            if student.name not in pending:
+                continue
+            pending.discard(student.name)
+            if self.get_source_hash(student) != source_hashes.get(student.name):
+                students_to_correct.append(student)
+        if students_to_correct:
+            self.students = students
+            self.correct_students(students_to_correct)
+            corrected_names = {student.name for student in students_to_correct}
+            self.save_results([student for student in self.students if student.name in corrected_names])
+            self.queue_ai_jobs(students_to_correct)
+            print(f"Corrected {len(students_to_correct)} new or modified submissions")
+        # Also the students left by earlier rounds, once the circuit breaker lets the requests through again
+        if self.do_bronco_detection:
+            self.run_ai_stage()
+
+    def watch(self):
+        # The testcase index, compilation cache and results database stay loaded between the rounds
+        print(f"Watching {self.students_path} every {self.watch_interval}s. Press Ctrl+C to stop")
+        signatures = {}
+        pending = set()
+        try:
+            while True:
+                try:
+                    self.correct_new_submissions(signatures, pending)
+                except Exception as e:
+                    print(f"Correction failed due to error: {e}")
+                    traceback.print_exc()
+                time.sleep(self.watch_interval)
+        except KeyboardInterrupt:
+            print("Watch stopped")
+        finally:
+            self.clean_up()
 
 
 
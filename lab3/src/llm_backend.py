@@ -0,0 +1,87 @@
+import os
+import json
+import types
+import hashlib
+import threading
+
+def load_environment():
+    # The .env is read on the first AI use, not when the correctors are imported
+    from dotenv import load_dotenv
+    load_dotenv()
+
+def get_api_keys():
+    # Comma separated, the requests are spread across them to get the quota of every key
+    load_environment()
+    api_keys = [api_key.strip() for api_key in os.getenv("GEMINI_API_KEYS", "").split(",") if api_key.strip()]
+    # Without any key the SDK says so on the first request
+    return api_keys or [os.getenv("GEMINI_API_KEY", "")]
+
+class GeminiBackend():
+    def __init__(self, api_keys, base_url=None):
+        self.api_keys = api_keys
+        self.num_keys = len(api_keys)
+        # Lets a local server (e.g. a fake one answering 429 and 503) stand in for the API
+        self.base_url = base_url
+        self.clients = None
+        self.lock = threading.Lock()
+
+    # The clients and the lock can't be sent to the --jobs workers, they are built again if needed
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["clients"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_clients(self):
+        with self.lock:
+            if self.clients is None:
+                # The SDK takes long to import, so only the corrections that make a request pay for it
+                from google import genai
+                self.clients = [
+                    genai.Client(api_key=api_key, http_options={"base_url": self.base_url} if self.base_url else None)
+                    for api_key in self.api_keys
+                ]
+        return self.clients
+
+    def generate(self, model, prompt, key_index):
+        return self.get_clients()[key_index].models.generate_content(model=model, contents=prompt)
+
+    async def generate_async(self, model, prompt, key_index):
+        return await self.get_clients()[key_index].aio.models.generate_content(model=model, contents=prompt)
+
+class MockBackend():
+    # Answers without network, for offline runs and CI. With a replay folder (the cache-ia of a real correction)
+    # the recorded answers are given back, any other prompt gets the fixed mock answer
+    def __init__(self, mock_text, replay_path=None):
+        self.mock_text = mock_text
+        self.replay_path = replay_path
+        self.num_keys = 1
+
+    def get_replayed_text(self, model, prompt):
+        if not self.replay_path:
+            return None
+        # Same entry names as the ResponseCache
+        key = hashlib.sha256(model.encode() + b"\0" + prompt.encode()).hexdigest()
+        try:
+            with open(os.path.join(self.replay_path, key + ".json"), encoding="utf-8") as entry_file:
+                return json.load(entry_file)["text"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def generate(self, model, prompt, key_index):
+        text = self.get_replayed_text(model, prompt)
+        return types.SimpleNamespace(text=self.mock_text if text is None else text, usage_metadata=None)
+
+    async def generate_async(self, model, prompt, key_index):
+        return self.generate(model, prompt, key_index)
+
+def create_backend(mock_text):
+    # AI_BACKEND=mock answers offline (AI_REPLAY_PATH replays a cache-ia folder), Gemini is the default
+    load_environment()
+    if os.getenv("AI_BACKEND", "gemini") == "mock":
+        return MockBackend(mock_text, os.getenv("AI_REPLAY_PATH"))
+    return GeminiBackend(get_api_keys(), os.getenv("GEMINI_BASE_URL"))
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+class ResponseCache():
+    def __init__(self, cache_path, max_size=64 * 1024 * 1024, ttl=30 * 24 * 60 * 60, refresh=False):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        # Seconds until a stored response is asked again
+        self.ttl = ttl
+        # Skips the stored responses, but still stores the new ones
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    # The lock can't be sent to the --jobs workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_key(self, model, prompt):
+        key = hashlib.sha256()
+        key.update(model.encode())
+        key.update(b"\0" + prompt.encode())
+        return key.hexdigest()
+
+    def get(self, model, prompt):
+        # Returns the stored response text, or None on a miss
+        entry_path = os.path.join(self.cache_path, self.get_key(model, prompt) + ".json")
+        text = None
+        if not self.refresh:
+            try:
+                with open(entry_path, encoding="utf-8") as entry_file:
+                    entry = json.load(entry_file)
+                if time.time() - entry["created_at"] <= self.ttl:
+                    text = entry["text"]
+                    # The entry mtime is the last use, for the LRU eviction
+                    os.utime(entry_path)
+            except (OSError, ValueError, KeyError):
+                pass
+        with self.lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return text
+
+    def put(self, model, prompt, text):
+        entry_path = os.path.join(self.cache_path, self.get_key(model, prompt) + ".json")
+        file_descriptor, temp_entry_path = tempfile.mkstemp(dir=self.cache_path, prefix=".tmp-")
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as entry_file:
+            json.dump({"model": model, "created_at": time.time(), "text": text}, entry_file)
+        os.replace(temp_entry_path, entry_path)
+        with self.lock:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        now = time.time()
+        with os.scandir(self.cache_path) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.startswith(".tmp-") or not dir_entry.is_file():
+                    continue
+                entry_stat = dir_entry.stat()
+                # Not used for longer than the TTL, so it was also created before it and can't be read anymore
+                if now - entry_stat.st_mtime > self.ttl:
+                    os.remove(dir_entry.path)
+                    continue
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, dir_entry.path))
+                total_size += entry_stat.st_size
+
+        # Least recently used entries go first
+        for _, entry_size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(entry_path)
+            total_size -= entry_size
@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS students (
+        name TEXT PRIMARY KEY,
+        error_type TEXT,
+        source_hash TEXT,
+        num_passed_testcases INTEGER,
+        num_total_testcases INTEGER,
+        logs TEXT,
+        corrected_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS students_error_type ON students (error_type);
+
+    CREATE TABLE IF NOT EXISTS testcase_results (
+        student TEXT,
+        testcase TEXT,
+        passed INTEGER,
+        messages TEXT,
+        wall_time REAL,
+        user_time REAL,
+        system_time REAL,
+        max_rss INTEGER,
+        bytes_written INTEGER,
+        PRIMARY KEY (student, testcase)
+    );
+    CREATE INDEX IF NOT EXISTS testcase_results_testcase ON testcase_results (testcase, passed);
+
+    CREATE TABLE IF NOT EXISTS ai_criterion_results (
+        student TEXT,
+        criterion_hash TEXT,
+        code_hash TEXT,
+        result TEXT,
+        PRIMARY KEY (student, criterion_hash)
+    );
+
+    CREATE TABLE IF NOT EXISTS ai_jobs (
+        student TEXT PRIMARY KEY,
+        attempts INTEGER,
+        last_error TEXT,
+        queued_at REAL
+    );
+'''
+
+class ResultsDatabase():
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = None
+
+    # Only the main process writes, the --jobs workers get a copy without the connection
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["connection"] = None
+        return state
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.db_path)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def get_error_types(self):
+        return dict(self.connect().execute("SELECT name, error_type FROM students"))
+
+    def get_source_hashes(self):
+        return dict(self.connect().execute("SELECT name, source_hash FROM students"))
+
+    def get_students_with_error_type(self, error_type):
+        rows = self.connect().execute("SELECT name FROM students WHERE error_type = ?", (error_type,))
+        return {name for name, in rows}
+
+    def get_testcase_results(self, student_name):
+        return self.connect().execute(
+            "SELECT testcase, passed, messages FROM testcase_results WHERE student = ? ORDER BY testcase",
+            (student_name,)
+        ).fetchall()
+
+    def get_ai_criterion_results(self):
+        # Student -> criterion hash -> (hash of the code it was answered for, answer)
+        results = {}
+        for student, criterion_hash, code_hash, result in self.connect().execute("SELECT student, criterion_hash, code_hash, result FROM ai_criterion_results"):
+            results.setdefault(student, {})[criterion_hash] = (code_hash, result)
+        return results
+
+    def save_ai_criterion_results(self, student_name, code_hash, results):
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO ai_criterion_results VALUES (?, ?, ?, ?)",
+                [(student_name, criterion_hash, code_hash, result) for criterion_hash, result in results.items()]
+            )
+
+    def queue_ai_jobs(self, student_names):
+        # A student queued again (e.g. after a new submission) starts over with no failed attempts
+        connection = self.connect()
+        queued_at = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO ai_jobs VALUES (?, 0, NULL, ?)",
+                [(student_name, queued_at) for student_name in student_names]
+            )
+
+    def get_ai_jobs(self):
+        return self.connect().execute("SELECT student, attempts FROM ai_jobs ORDER BY queued_at, student").fetchall()
+
+    def fail_ai_job(self, student_name, error):
+        with self.connect() as connection:
+            connection.execute("UPDATE ai_jobs SET attempts = attempts + 1, last_error = ? WHERE student = ?", (error, student_name))
+
+    def remove_ai_job(self, student_name):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM ai_jobs WHERE student = ?", (student_name,))
+
+    def save_students(self, students, source_hashes):
+        connection = self.connect()
+        corrected_at = time.time()
+        with connection:
+            for student in students:
+                connection.execute(
+                    "INSERT OR REPLACE INTO students VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        student.name,
+                        student.error_type,
+                        source_hashes.get(student.name),
+                        student.num_passed_testcases,
+                        len(student.testcase_results),
+                        "\n".join(student.logs),
+                        corrected_at
+                    )
+                )
+                connection.execute("DELETE FROM testcase_results WHERE student = ?", (student.name,))
+                for testcase, (passed, messages) in student.testcase_results.items():
+                    usage = student.run_usages.get(testcase)
+                    connection.execute(
+                        "INSERT INTO testcase_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            student.name,
+                            testcase,
+                            passed,
+                            "\n".join(messages),
+                            usage.wall_time if usage else None,
+                            usage.user_time if usage else None,
+                            usage.system_time if usage else None,
+                            usage.max_rss if usage else None,
+                            usage.bytes_written if usage else None
+                        )
+                    )
+
+    def export_error_type_txts(self, student_errors_path, error_files):
+        # The old erros-alunos files, one per error type with a student name per line
+        os.makedirs(student_errors_path, exist_ok=True)
+        for file in error_files:
+            error_file_path = os.path.join(student_errors_path, file)
+            if os.path.isfile(error_file_path):
+                os.remove(error_file_path)
+        rows = self.connect().execute("SELECT name, error_type FROM students WHERE error_type IS NOT NULL ORDER BY name")
+        for name, error_type in rows:
+            with open(os.path.join(student_errors_path, f"{error_type}.txt"), "a") as file:
+                file.write(name + "\n")
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import src.utils as utils
+
+# Usage: python lab4/benchmarks/output_normalization.py [size in MB]
+
+def old_convert_special_caracters(string):
+    for orig, repl in utils.SPECIAL_CARACTERS.items():
+        string = string.replace(orig, repl)
+    return string
+
+def old_read_file_lines(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return [old_convert_special_caracters(line) for line in f.readlines()]
+    except UnicodeDecodeError:
+        with open(path, encoding='latin1') as f:
+            return [old_convert_special_caracters(line) for line in f.readlines()]
+
+def make_output(path, size, encoding):
+    words = ["Ordenação", "comparações", "número", "trocas", "Início", "1234", "-57", "merge"]
+    random.seed(0)
+    written = 0
+    with open(path, "w", encoding=encoding) as f:
+        while written < size:
+            line = " ".join(random.choice(words) for _ in range(3)) + "\n"
+            f.write(line)
+            written += len(line)
+
+def measure(function, path):
+    start = time.perf_counter()
+    lines = function(path)
+    return time.perf_counter() - start, lines
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for encoding in ["utf-8", "latin1"]:
+        with tempfile.NamedTemporaryFile(suffix=".txt") as output_file:
+            make_output(output_file.name, size * 1024 * 1024, encoding)
+            # The old code converted the lines a second time in get_and_process_outputs
+            old_time, old_lines = measure(lambda path: [old_convert_special_caracters(line) for line in old_read_file_lines(path)], output_file.name)
+            new_time, new_lines = measure(utils.read_file_lines, output_file.name)
+            assert old_lines == new_lines
+            print(f"{size} MB {encoding}: old {old_time:.2f}s, new {new_time:.2f}s ({old_time / new_time:.1f}x)")
@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+import subprocess
+import statistics
+
+LAB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Usage: python lab4/benchmarks/startup.py [runs]
+
+# What main.py loads before correcting, without and with the AI (the SDK is only imported on the first request)
+WITHOUT_AI = "import src.lab_corrector, dados_lab"
+WITH_AI = WITHOUT_AI + "; from src.llm_backend import GeminiBackend; GeminiBackend(['chave']).get_clients()"
+
+def measure(code, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=LAB_PATH, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def is_sdk_imported(code):
+    check = f"import sys; {code}; print('google.genai' in sys.modules)"
+    return subprocess.run([sys.executable, "-c", check], cwd=LAB_PATH, check=True, capture_output=True, text=True).stdout.strip() == "True"
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    baseline_time = measure("pass", runs)
+    for name, code in [("without AI", WITHOUT_AI), ("with AI", WITH_AI)]:
+        import_time = measure(code, runs) - baseline_time
+        print(f"{name}: {import_time * 1000:.0f}ms (SDK imported: {is_sdk_imported(code)})")
@@ -2,6 +2,13 @@ from src.lab_corrector import LabCorrector
 from dados_lab import DadosLab
 
 
-corrector = LabCorrector(DadosLab())
+if __name__ == "__main__":
+    dados_lab = DadosLab()
+    corrector = LabCorrector(dados_lab)
 
-corrector.make_correction()
\ No newline at end of file
+    if dados_lab.ai_only:
+        corrector.make_ai_correction()
+    elif dados_lab.watch:
+        corrector.watch()
+    else:
+        corrector.make_correction()
\ No newline at end of file
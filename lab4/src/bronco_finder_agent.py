@@ -1,17 +1,24 @@
-import os
-from dotenv import load_dotenv
-from google import genai
+import asyncio
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
+from src.rate_limiter import TokenUsage, estimate_tokens, get_error_code, is_retryable, get_retry_delay
+from src.llm_backend import create_backend
 
-load_dotenv()
-
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
+MODEL = "gemini-2.5-flash"
+# Answer of the mock backend (AI_BACKEND=mock) for the prompts it has no recording of
+MOCK_TEXT = "Nenhum problema identificado"
 
 import time
 
 class CorrectorAgent:
-    def __init__(self, correction_criteria):
+    def __init__(self, correction_criteria, cache=None, rate_limiter=None, backend=None):
         self.correction_criteria = correction_criteria
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        # Gemini unless another backend is given or AI_BACKEND selects the mock, its SDK is only loaded on the first request
+        self.backend = backend or create_backend(MOCK_TEXT)
+        # Spreads the requests across the keys when there is no rate limiter picking them
+        self.num_requests = 0
 
     def post_process(self, response_text):
         lines = response_text.splitlines()
@@ -23,25 +30,120 @@ class CorrectorAgent:
             lines = []
         return lines
     
-    def respond(self, user_input, max_retries=10, delay=10):
-        attempt = 1
-        while attempt < max_retries:
+    def handle_failed_attempt(self, error, attempt, max_retries, base_delay, max_delay, key_index):
+        # Raises the error if it can't be retried, otherwise returns how long to wait before the next attempt
+        if not is_retryable(error):
+            print(f"An unexpected error occurred: {error}")
+            raise error
+        if attempt == max_retries:
+            raise RuntimeError(f"All {max_retries} attempts failed, the last one with: {error}") from error
+        delay = get_retry_delay(error, attempt, base_delay, max_delay)
+        if self.rate_limiter and get_error_code(error) == 429:
+            # Only this key cools down, the next attempt goes to a key with quota left (or waits for one)
+            self.rate_limiter.pause(key_index, delay)
+            delay = 0
+        print(f"Attempt {attempt} failed with {get_error_code(error) or type(error).__name__} on key {key_index + 1}. Retrying in {delay:.1f} seconds...")
+        return delay
+
+    def respond(self, user_input, max_retries=10, base_delay=2, max_delay=60, usage=None):
+        if self.cache:
+            cached_text = self.cache.get(MODEL, user_input)
+            if cached_text is not None:
+                if usage:
+                    usage.add_cached()
+                return self.post_process(cached_text)
+        self.num_requests += 1
+        # Counted before sending, the latency also has the waits for the rate limiter and the retries
+        prompt_tokens = estimate_tokens(user_input)
+        start_time = time.perf_counter()
+        for attempt in range(1, max_retries + 1):
+            key_index = (self.num_requests + attempt) % self.backend.num_keys
+            if self.rate_limiter:
+                key_index = self.rate_limiter.acquire(prompt_tokens)
             try:
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash", 
-                    contents=user_input
-                )
-                
-                return self.post_process(response.text)
+                response = self.backend.generate(MODEL, user_input, key_index)
+            except Exception as e:
+                delay = self.handle_failed_attempt(e, attempt, max_retries, base_delay, max_delay, key_index)
+                time.sleep(delay)
+                continue
+            if self.cache:
+                self.cache.put(MODEL, user_input, response.text)
+            if usage:
+                usage.add_response(response, prompt_tokens, time.perf_counter() - start_time)
+            
+            return self.post_process(response.text)
 
+    async def respond_async(self, user_input, max_retries=10, base_delay=2, max_delay=60, usage=None):
+        if self.cache:
+            cached_text = self.cache.get(MODEL, user_input)
+            if cached_text is not None:
+                if usage:
+                    usage.add_cached()
+                return self.post_process(cached_text)
+        self.num_requests += 1
+        # Counted before sending, the latency also has the waits for the rate limiter and the retries
+        prompt_tokens = estimate_tokens(user_input)
+        start_time = time.perf_counter()
+        for attempt in range(1, max_retries + 1):
+            key_index = (self.num_requests + attempt) % self.backend.num_keys
+            if self.rate_limiter:
+                key_index = await self.rate_limiter.acquire_async(prompt_tokens)
+            try:
+                response = await self.backend.generate_async(MODEL, user_input, key_index)
             except Exception as e:
-                if "503" in str(e) or "UNAVAILABLE" in str(e):
-                    print(f"Attempt {attempt} failed with 503/UNAVAILABLE. Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                    if attempt < 10:
-                        attempt += 1
-                        continue
-                else:
-                    print(f"An unexpected error occurred: {e}")
-                    raise e
-            raise RuntimeError(f"All {max_retries} attempts failed due to 503/UNAVAILABLE errors.")
+                delay = self.handle_failed_attempt(e, attempt, max_retries, base_delay, max_delay, key_index)
+                await asyncio.sleep(delay)
+                continue
+            if self.cache:
+                self.cache.put(MODEL, user_input, response.text)
+            if usage:
+                usage.add_response(response, prompt_tokens, time.perf_counter() - start_time)
+            
+            return self.post_process(response.text)
+
+class AgentRequestPool:
+    # Runs the agent requests on an event loop in a background thread, at most max_concurrent_requests at a time
+    def __init__(self, agent, max_concurrent_requests, max_retries=10):
+        self.agent = agent
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_retries = max_retries
+        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self.requests = {}
+        # Tokens and latency of each submitted key, and of every request made by the pool
+        self.usages = {}
+        self.usage = TokenUsage()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    # The requests are only made and awaited in the main process, the --jobs workers get a copy without the loop
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["semaphore"] = None
+        state["requests"] = {}
+        state["usages"] = {}
+        state["loop"] = None
+        return state
+
+    async def limited_respond(self, user_input, usage):
+        async with self.semaphore:
+            response = await self.agent.respond_async(user_input, max_retries=self.max_retries, usage=usage)
+        self.usage.add(usage)
+        return response
+
+    def submit(self, key, user_input):
+        self.usages[key] = TokenUsage()
+        self.requests[key] = asyncio.run_coroutine_threadsafe(self.limited_respond(user_input, self.usages[key]), self.loop)
+
+    def is_submitted(self, key):
+        return key in self.requests
+
+    def wait_next(self):
+        # Blocks until one of the requests not yet taken with result is done, and returns its key
+        keys = {request: key for key, request in self.requests.items()}
+        done, _ = wait(keys, return_when=FIRST_COMPLETED)
+        return keys[next(iter(done))]
+
+    def result(self, key):
+        # Blocks until the response arrives. None if no request was made for the key
+        request = self.requests.pop(key, None)
+        return request.result() if request else None
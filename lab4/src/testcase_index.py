@@ -0,0 +1,30 @@
+import os
+import re
+import json
+import src.utils as utils
+
+class TestcaseIndex():
+    def __init__(self, testcases_path, numero_lab, json_field_with_array, array_regexes, value_to_regexes):
+        # Sorted, so the testcases always run and get logged in the same order
+        self.testcases = sorted(os.listdir(testcases_path))
+        self.answers = {}
+        self.line_regexes_from_json = {}
+        for testcase in self.testcases:
+            answers_path = os.path.join(testcases_path, testcase, f'saida{numero_lab}.json')
+            with open(answers_path, "r", encoding="utf-8") as answers_file:
+                self.answers[testcase] = json.load(answers_file)
+            self.line_regexes_from_json[testcase] = utils.compile_regexes(
+                utils.make_regex_to_match_string(utils.convert_special_caracters(string))
+                for string in self.answers[testcase][json_field_with_array]
+            )
+
+        self.array_regexes = {
+            "lines": utils.compile_regexes(array_regexes["lines"]),
+            "values": utils.compile_regexes(array_regexes["values"])
+        }
+        self.value_to_regexes = {}
+        for value_name in value_to_regexes:
+            self.value_to_regexes[value_name] = {
+                "lines": utils.compile_regexes(value_to_regexes[value_name]["lines"]),
+                "values": utils.compile_regexes(value_to_regexes[value_name]["values"])
+            }
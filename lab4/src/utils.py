@@ -1,49 +1,87 @@
+import os
+import io
 import re
+import mmap
+import codecs
+import contextlib
+
+# Replace common special/accented characters with ASCII equivalents.
+SPECIAL_CARACTERS = {
+    'ç': 'c',
+    'Ç': 'C',
+    'ã': 'a',
+    'Ã': 'A',
+    'á': 'a',
+    'Á': 'A',
+    'à': 'a',
+    'À': 'A',
+    'â': 'a',
+    'Â': 'A',
+    'é': 'e',
+    'É': 'E',
+    'ê': 'e',
+    'Ê': 'E',
+    'í': 'i',
+    'Í': 'I',
+    'ó': 'o',
+    'Ó': 'O',
+    'õ': 'o',
+    'Õ': 'O',
+    'ô': 'o',
+    'Ô': 'O',
+    'ú': 'u',
+    'Ú': 'U',
+    'ü': 'u',
+    'Ü': 'U',
+}
+
+# All of them are in latin1, so the folding can be done by bytes.translate in a single pass
+LATIN1_SPECIAL_CARACTERS_TABLE = bytes.maketrans(
+    "".join(SPECIAL_CARACTERS).encode("latin1"),
+    "".join(SPECIAL_CARACTERS.values()).encode("latin1")
+)
 
 def convert_special_caracters(string):
-    # Replace common special/accented characters with ASCII equivalents.
-    replacements = {
-        'ç': 'c',
-        'Ç': 'C',
-        'ã': 'a',
-        'Ã': 'A',
-        'á': 'a',
-        'Á': 'A',
-        'à': 'a',
-        'À': 'A',
-        'â': 'a',
-        'Â': 'A',
-        'é': 'e',
-        'É': 'E',
-        'ê': 'e',
-        'Ê': 'E',
-        'í': 'i',
-        'Í': 'I',
-        'ó': 'o',
-        'Ó': 'O',
-        'õ': 'o',
-        'Õ': 'O',
-        'ô': 'o',
-        'Ô': 'O',
-        'ú': 'u',
-        'Ú': 'U',
-        'ü': 'u',
-        'Ü': 'U',
-    }
-    
-    for orig, repl in replacements.items():
-        string = string.replace(orig, repl)
-    return string
+    if string.isascii():
+        return string
+    try:
+        return string.encode("latin1").translate(LATIN1_SPECIAL_CARACTERS_TABLE).decode("latin1")
+    except UnicodeEncodeError:
+        # Characters outside latin1, str.translate would handle them but is much slower than str.replace
+        for orig, repl in SPECIAL_CARACTERS.items():
+            string = string.replace(orig, repl)
+        return string
+
+def decode(data):
+    # str() instead of data.decode, so it also takes a memory-mapped file
+    try:
+        return str(data, "utf-8")
+    except UnicodeDecodeError:
+        return str(data, "latin1")
 
 def make_regex_to_match_string(string):
     return re.escape(string)
 
+def compile_regexes(pattern_list, ignorecase=True):
+    ignorecase_flag = re.IGNORECASE if ignorecase else 0
+    return [re.compile(pattern, ignorecase_flag) for pattern in pattern_list]
+
+def search(regex, string, flags):
+    # Compiled patterns already carry their flags
+    if isinstance(regex, re.Pattern):
+        return regex.search(string)
+    return re.search(regex, string, flags)
+
+def count_matching_regexes(line, pattern_list, ignorecase=True):
+    ignorecase_flag = re.IGNORECASE if ignorecase else 0
+    return sum(1 for regex in pattern_list if search(regex, line, ignorecase_flag))
+
 def get_lines_that_matches_any_regex(text_as_str_list, pattern_list, ignorecase=True, return_first_match_only=True):
     ignorecase_flag = re.IGNORECASE if ignorecase else 0
     matches = []
     for line in text_as_str_list:
         for regex in pattern_list:
-            match = re.search(regex, line, ignorecase_flag)
+            match = search(regex, line, ignorecase_flag)
             if match:
                 if return_first_match_only:
                     return line
@@ -56,7 +94,7 @@ def get_substrings_that_matches_any_regex(string, pattern_list, ignorecase=True,
     ignorecase_flag = re.IGNORECASE if ignorecase else 0
     matches = []
     for regex in pattern_list:
-        match = re.search(regex, string, ignorecase_flag)
+        match = search(regex, string, ignorecase_flag)
         if match:
             if return_first_match_only:
                 return match.group()
@@ -85,10 +123,48 @@ def get_first_matches_in_many_matching_lines(lines, line_pattern_list, value_pat
 
     return values
 
+@contextlib.contextmanager
+def map_file(path):
+    # The file is scanned straight from the page cache, without being read into a buffer first
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap can't map an empty file
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
 def read_file_lines(path):
+    # The file is decoded once, and the whole text is converted at once instead of line by line
+    with map_file(path) as data:
+        text = convert_special_caracters(decode(data))
+    # newline=None splits the lines the same way a file opened in text mode does
+    return io.StringIO(text, newline=None).readlines()
+
+def get_file_encoding(data, chunk_size=1 << 20):
+    # The whole mapping is checked once, a single invalid byte makes every line latin1 (as decode does for a whole file).
+    # Only the chunks that aren't ascii, or that continue a character split between chunks, go through the decoder
+    decoder = codecs.getincrementaldecoder("utf-8")()
     try:
-        with open(path, encoding='utf-8') as f:
-            return [convert_special_caracters(line) for line in f.readlines()]
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            if not chunk.isascii() or decoder.getstate()[0]:
+                decoder.decode(chunk)
+        decoder.decode(b"", final=True)
     except UnicodeDecodeError:
-        with open(path, encoding='latin1') as f:
-            return [convert_special_caracters(line) for line in f.readlines()]
\ No newline at end of file
+        return "latin1"
+    return "utf-8"
+
+def iter_file_lines(path):
+    # One line at a time, so a huge output is never fully in memory
+    with map_file(path) as data:
+        if not data:
+            return
+        encoding = get_file_encoding(data)
+        for raw_line in iter(data.readline, b""):
+            line = convert_special_caracters(str(raw_line, encoding))
+            if "\r" in line:
+                # Same line splitting as a file opened in text mode
+                yield from io.StringIO(line, newline=None).readlines()
+            else:
+                yield line